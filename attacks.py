@@ -0,0 +1,265 @@
+import functools
+from typing import Iterable, Optional
+from chess import BB_ALL, BB_EMPTY, BB_SQUARES, SQUARES, Bitboard, Square, lsb, msb, _carry_rippler
+
+# Precomputed attack tables for Betza move atoms, in the spirit of
+# BB_KNIGHT_ATTACKS and friends from the python-chess library.
+# Riders are indexed by relevant occupancy like BB_RANK_ATTACKS.
+# Directions use the same encoding as from_betza: rank offset * 8 + file offset.
+
+def direction_in_2d(direction: int):
+    dir_y = int(round(direction / 8))
+    return direction - dir_y * 8, dir_y
+
+def _offset_square(square: Square, dir_x: int, dir_y: int) -> Optional[Square]:
+    to_x = (square & 7) + dir_x
+    to_y = (square >> 3) + dir_y
+    if (0 <= to_x < 8 and 0 <= to_y < 8):
+        return (to_y << 3) + to_x
+    return None
+
+@functools.lru_cache(maxsize=None)
+def direction_shift(direction: int) -> tuple[Bitboard, int]:
+    # Squares that stay on the board when stepping in this direction, and the matching bit shift.
+    # Masking before shifting keeps set-wise steps from wrapping around the edges of the board.
+    mask = BB_EMPTY
+    for square in SQUARES:
+        if (_offset_square(square, *direction_in_2d(direction)) is not None):
+            mask |= BB_SQUARES[square]
+    return mask, direction
+
+def _leaper_attacks(square: Square, directions: Iterable[int]) -> Bitboard:
+    attacks = BB_EMPTY
+    for direction in directions:
+        to_square = _offset_square(square, *direction_in_2d(direction))
+        if (to_square is not None):
+            attacks |= BB_SQUARES[to_square]
+    return attacks
+
+@functools.lru_cache(maxsize=None)
+def _leaper_table(directions: tuple[int, ...]) -> tuple[Bitboard, ...]:
+    return tuple(_leaper_attacks(sq, directions) for sq in SQUARES)
+
+def leaper_table(directions: Iterable[int]) -> tuple[Bitboard, ...]:
+    # Tables are shared between all pieces with the same set of leaps
+    return _leaper_table(tuple(sorted(set(directions))))
+
+def rider_range(distance: int) -> int:
+    # A distance of 0 means the rider is unlimited, which is at most 7 steps on a 8x8 board
+    return distance if (distance > 0) else 7
+
+def _rider_attacks(square: Square, occupied: Bitboard, directions: Iterable[int], distance: int) -> Bitboard:
+    attacks = BB_EMPTY
+    for direction in directions:
+        dir_x, dir_y = direction_in_2d(direction)
+        current = square
+        for step in range (distance):
+            current = _offset_square(current, dir_x, dir_y)
+            if (current is None):
+                break
+            attacks |= BB_SQUARES[current]
+            if (occupied & BB_SQUARES[current]):
+                break
+    return attacks
+
+def _rider_mask(square: Square, directions: Iterable[int], distance: int) -> Bitboard:
+    # Only the squares before the last one of each ray can block the rider
+    mask = BB_EMPTY
+    for direction in directions:
+        dir_x, dir_y = direction_in_2d(direction)
+        ray = []
+        current = square
+        for step in range (distance):
+            current = _offset_square(current, dir_x, dir_y)
+            if (current is None):
+                break
+            ray.append(current)
+        for sq in ray[:-1]:
+            mask |= BB_SQUARES[sq]
+    return mask
+
+@functools.lru_cache(maxsize=None)
+def rider_attack_table(directions: tuple[int, ...], distance: int) -> tuple[list[Bitboard], list[dict[Bitboard, Bitboard]]]:
+    # Same layout as BB_RANK_MASKS/BB_RANK_ATTACKS: attacks[square][masks[square] & occupied]
+    distance = rider_range(distance)
+    mask_table = []
+    attack_table = []
+
+    for square in SQUARES:
+        attacks = {}
+
+        mask = _rider_mask(square, directions, distance)
+        for subset in _carry_rippler(mask):
+            attacks[subset] = _rider_attacks(square, subset, directions, distance)
+
+        attack_table.append(attacks)
+        mask_table.append(mask)
+
+    return mask_table, attack_table
+
+def rider_tables(slider: dict[int, int]) -> tuple[tuple[list[Bitboard], list[dict[Bitboard, Bitboard]]], ...]:
+    # Opposite directions with the same range share a table, like the ranks and files of python-chess
+    tables = []
+    for direction, distance in sorted(slider.items()):
+        if (slider.get(-direction) == distance):
+            if (direction < 0):
+                tables.append(rider_attack_table((direction, -direction), distance))
+        else:
+            tables.append(rider_attack_table((direction, ), distance))
+    return tuple(tables)
+
+def rider_attacks(tables, square: Square, occupied: Bitboard) -> Bitboard:
+    attacks = BB_EMPTY
+    for masks, table in tables:
+        attacks |= table[square][masks[square] & occupied]
+    return attacks
+
+def _crooked_paths(square: Square, direction: int, distance: int) -> dict[Square, Bitboard]:
+    # Zigzag along the direction and one of its perpendiculars, remembering the squares passed on the way
+    paths = {}
+    dir_x, dir_y = direction_in_2d(direction)
+    limit = distance if (distance > 0) else 64
+    for perp_x, perp_y in ((-dir_y, dir_x), (dir_y, -dir_x)):
+        current = square
+        path = BB_EMPTY
+        for step in range (1, limit + 1):
+            if (step % 2 == 1):
+                current = _offset_square(current, dir_x, dir_y)
+            else:
+                current = _offset_square(current, perp_x, perp_y)
+            if (current is None):
+                break
+            paths[current] = path
+            path |= BB_SQUARES[current]
+    return paths
+
+@functools.lru_cache(maxsize=None)
+def crooked_path_table(direction: int, distance: int) -> tuple[dict[Square, Bitboard], ...]:
+    # Maps every reachable target to the bitboard of squares that must be empty to get there
+    return tuple(_crooked_paths(sq, direction, distance) for sq in SQUARES)
+
+def crooked_tables(crooked: dict[int, int]) -> tuple[tuple[tuple[Bitboard, Bitboard], ...], ...]:
+    # All zigzags of a piece flattened into (target, path) pairs per square
+    tables = [crooked_path_table(direction, distance) for direction, distance in sorted(crooked.items())]
+    return tuple(
+        tuple((BB_SQUARES[target], path) for table in tables for target, path in table[sq].items())
+        for sq in SQUARES)
+
+def crooked_attacks(table, square: Square, occupied: Bitboard) -> Bitboard:
+    attacks = BB_EMPTY
+    for target, path in table[square]:
+        if (not path & occupied):
+            attacks |= target
+    return attacks
+
+@functools.lru_cache(maxsize=None)
+def ray_table(direction: int) -> tuple[Bitboard, ...]:
+    # Every square from each square onwards in one direction, up to the edge of the board
+    return tuple(_rider_attacks(sq, BB_EMPTY, (direction, ), rider_range(0)) for sq in SQUARES)
+
+def hopper_tables(hopper: dict[int, int]) -> tuple[tuple[int, tuple[Bitboard, ...], tuple], ...]:
+    # The landing squares beyond a screen are those of a rider starting on the screen
+    return tuple((direction, ray_table(direction), rider_attack_table((direction, ), distance))
+                 for direction, distance in sorted(hopper.items()))
+
+def hopper_attacks(tables, square: Square, occupied: Bitboard) -> Bitboard:
+    attacks = BB_EMPTY
+    for direction, rays, (masks, table) in tables:
+        blockers = rays[square] & occupied
+        if (blockers):
+            # Directions always move towards higher squares if positive, lower ones if negative
+            screen = lsb(blockers) if (direction > 0) else msb(blockers)
+            attacks |= table[screen][masks[screen] & occupied]
+    return attacks
+
+# Reverse tables: the squares from which a piece attacks a given square
+
+def reverse_hopper_tables(hopper: dict[int, int]) -> tuple[tuple[int, tuple, tuple[Bitboard, ...]], ...]:
+    # Walking back from the target, the range limits the way to the screen instead of the landing
+    return tuple((-direction, rider_attack_table((-direction, ), distance), ray_table(-direction))
+                 for direction, distance in sorted(hopper.items()))
+
+def reverse_hopper_attacks(tables, square: Square, occupied: Bitboard) -> Bitboard:
+    attackers = BB_EMPTY
+    for direction, (masks, table), rays in tables:
+        screen = table[square][masks[square] & occupied] & occupied
+        if (screen):
+            blockers = rays[lsb(screen)] & occupied
+            if (blockers):
+                attackers |= BB_SQUARES[lsb(blockers) if (direction > 0) else msb(blockers)]
+    return attackers
+
+def reverse_crooked_tables(table) -> tuple[tuple[tuple[Bitboard, Bitboard], ...], ...]:
+    # Same (square, path) layout as crooked_tables, so crooked_attacks works on it as well
+    reverse = [[] for sq in SQUARES]
+    for sq in SQUARES:
+        for target, path in table[sq]:
+            reverse[lsb(target)].append((BB_SQUARES[sq], path))
+    return tuple(tuple(pairs) for pairs in reverse)
+
+# Set-wise attacks: all pieces of a kind at once, one shift per step instead of one lookup per square
+
+KNIGHT_DIRECTIONS = (17, 15, 10, 6, -6, -10, -15, -17)
+KING_DIRECTIONS = (9, 8, 7, 1, -1, -7, -8, -9)
+DIAGONAL_DIRECTIONS = (9, 7, -7, -9)
+ORTHOGONAL_DIRECTIONS = (8, 1, -1, -8)
+# Indexed by color like BB_PAWN_ATTACKS
+PAWN_CAPTURE_DIRECTIONS = [(-7, -9), (7, 9)]
+
+@functools.lru_cache(maxsize=None)
+def _step_targets(direction: int) -> Bitboard:
+    # Squares that can be reached by one step in this direction without leaving the board
+    return direction_shift(-direction)[0]
+
+def shift_step(bb: Bitboard, direction: int) -> Bitboard:
+    mask, shift = direction_shift(direction)
+    bb &= mask
+    return bb << shift if (shift > 0) else bb >> -shift
+
+def _shift_raw(bb: Bitboard, shift: int) -> Bitboard:
+    return (bb << shift) & BB_ALL if (shift > 0) else bb >> -shift
+
+def occluded_fill(pieces: Bitboard, empty: Bitboard, direction: int, distance: int = 0) -> Bitboard:
+    # Squares attacked along one direction: the rays stop on the first occupied square, which is included
+    if (distance <= 0 or distance >= 7):
+        # Kogge-Stone: the propagator only holds empty squares a step in this direction can land on,
+        # so doubling the shift never wraps around the edge of the board
+        propagator = empty & _step_targets(direction)
+        pieces |= propagator & _shift_raw(pieces, direction)
+        propagator &= _shift_raw(propagator, direction)
+        pieces |= propagator & _shift_raw(pieces, 2 * direction)
+        propagator &= _shift_raw(propagator, 2 * direction)
+        pieces |= propagator & _shift_raw(pieces, 4 * direction)
+        return shift_step(pieces, direction)
+    attacks = BB_EMPTY
+    for step in range (distance):
+        pieces = shift_step(pieces, direction)
+        attacks |= pieces
+        pieces &= empty
+    return attacks
+
+def setwise_attacks(pieces: Bitboard, occupied: Bitboard, steps: dict[int, int], slider: dict[int, int],
+                    hopper: dict[int, int], crooked: dict[int, int]) -> Bitboard:
+    # Union of the attacks of every piece in pieces, for the atoms of one modality of a compiled piece
+    empty = ~occupied & BB_ALL
+    attacks = BB_EMPTY
+    for direction in steps:
+        attacks |= shift_step(pieces, direction)
+    for direction, distance in slider.items():
+        attacks |= occluded_fill(pieces, empty, direction, distance)
+    for direction, distance in hopper.items():
+        screens = occluded_fill(pieces, empty, direction) & occupied
+        attacks |= occluded_fill(screens, empty, direction, distance)
+    for direction, distance in crooked.items():
+        # Zigzags turn every step, so they are walked one step at a time like attacks._crooked_paths
+        dir_x, dir_y = direction_in_2d(direction)
+        limit = distance if (distance > 0) else 64
+        for perp_x, perp_y in ((-dir_y, dir_x), (dir_y, -dir_x)):
+            current = pieces
+            for step in range (1, limit + 1):
+                current = shift_step(current, direction if step % 2 == 1 else perp_y * 8 + perp_x)
+                attacks |= current
+                current &= empty
+                if (not current):
+                    break
+    return attacks
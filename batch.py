@@ -0,0 +1,193 @@
+from typing import Iterable, Optional
+import numpy as np
+from board import *
+
+# Many positions at once as NumPy uint64 arrays, one entry per position.
+# Attacks are computed set-wise: every piece of a kind moves one step per array shift,
+# using the atoms of the compiled Betza pieces, so the Python loops only run over directions.
+
+U64 = np.uint64
+
+def _shift(bbs: np.ndarray, direction: int) -> np.ndarray:
+    mask, shift = direction_shift(direction)
+    bbs = bbs & U64(mask)
+    return bbs << U64(shift) if (shift > 0) else bbs >> U64(-shift)
+
+def _leap(pieces: np.ndarray, directions: Iterable[int]) -> np.ndarray:
+    attacks = np.zeros_like(pieces)
+    for direction in directions:
+        attacks |= _shift(pieces, direction)
+    return attacks
+
+def _ride(pieces: np.ndarray, empty: np.ndarray, direction: int, distance: int) -> np.ndarray:
+    # Occluded fill: the rays stop on the first occupied square, which is attacked
+    attacks = np.zeros_like(pieces)
+    for step in range (rider_range(distance)):
+        pieces = _shift(pieces, direction)
+        attacks |= pieces
+        pieces &= empty
+        if (not pieces.any()):
+            break
+    return attacks
+
+def _hop(pieces: np.ndarray, empty: np.ndarray, direction: int, distance: int) -> np.ndarray:
+    # Find the first occupied square on each ray, then ride on from it
+    screens = np.zeros_like(pieces)
+    for step in range (rider_range(0)):
+        pieces = _shift(pieces, direction)
+        screens |= pieces & ~empty
+        pieces &= empty
+        if (not pieces.any()):
+            break
+    return _ride(screens, empty, direction, distance)
+
+def _zigzag(pieces: np.ndarray, empty: np.ndarray, direction: int, distance: int) -> np.ndarray:
+    # Same walk as attacks._crooked_paths, alternating the direction and one of its perpendiculars
+    attacks = np.zeros_like(pieces)
+    dir_x, dir_y = direction_in_2d(direction)
+    limit = distance if (distance > 0) else 64
+    for perp_x, perp_y in ((-dir_y, dir_x), (dir_y, -dir_x)):
+        current = pieces
+        for step in range (1, limit + 1):
+            current = _shift(current, direction if step % 2 == 1 else perp_y * 8 + perp_x)
+            attacks |= current
+            current &= empty
+            if (not current.any()):
+                break
+    return attacks
+
+def compiled_attacks(pieces: np.ndarray, empty: np.ndarray, compiled: CompiledPiece, modality: int) -> np.ndarray:
+    attacks = _leap(pieces, compiled.steps[modality])
+    for direction, distance in compiled.slider[modality].items():
+        attacks |= _ride(pieces, empty, direction, distance)
+    for direction, distance in compiled.hopper[modality].items():
+        attacks |= _hop(pieces, empty, direction, distance)
+    for direction, distance in compiled.crooked[modality].items():
+        attacks |= _zigzag(pieces, empty, direction, distance)
+    return attacks
+
+class BoardBatch:
+    def __init__(self, size: int):
+        self.pawns = np.zeros(size, dtype=U64)
+        self.knights = np.zeros(size, dtype=U64)
+        self.bishops = np.zeros(size, dtype=U64)
+        self.rooks = np.zeros(size, dtype=U64)
+        self.queens = np.zeros(size, dtype=U64)
+        self.kings = np.zeros(size, dtype=U64)
+        self.occupied_co = [np.zeros(size, dtype=U64), np.zeros(size, dtype=U64)]
+        self.turn = np.ones(size, dtype=bool)
+        # Custom piece bitboards by Betza definition, since boards may give one custom type different
+        # moves, and the pawn type of each position (1 for standard pawns)
+        self.custom_pieces: dict[str, np.ndarray] = {}
+        self.pawn_types = np.ones(size, dtype=np.int8)
+
+    @classmethod
+    def from_boards(cls, boards: list[CustomBoard]) -> "BoardBatch":
+        batch = cls(len(boards))
+        for index, board in enumerate(boards):
+            batch.pawns[index] = board.pawns
+            batch.knights[index] = board.knights
+            batch.bishops[index] = board.bishops
+            batch.rooks[index] = board.rooks
+            batch.queens[index] = board.queens
+            batch.kings[index] = board.kings
+            batch.occupied_co[WHITE][index] = board.occupied_co[WHITE]
+            batch.occupied_co[BLACK][index] = board.occupied_co[BLACK]
+            batch.turn[index] = board.turn
+            batch.pawn_types[index] = board.custom_pawn_type()
+            for piece_type, mask in zip(board.custom_piece_types, board.custom_pieces):
+                betza = board.betza_of(piece_type) or ""
+                if (betza not in batch.custom_pieces):
+                    batch.custom_pieces[betza] = np.zeros(len(boards), dtype=U64)
+                batch.custom_pieces[betza][index] |= mask
+        return batch
+
+    @classmethod
+    def from_bytes(cls, positions: Iterable[bytes],
+                   definitions: Iterable[tuple[CustomPieceType, Optional[str]]] = ()) -> "BoardBatch":
+        boards = [CustomBoard.from_bytes(data) for data in positions]
+        definitions = tuple(definitions)
+        for board in boards:
+            board.set_piece_definitions(definitions)
+        return cls.from_boards(boards)
+
+    def __len__(self) -> int:
+        return len(self.pawns)
+
+    @property
+    def occupied(self) -> np.ndarray:
+        return self.occupied_co[WHITE] | self.occupied_co[BLACK]
+
+    def _side(self, color: Optional[Color]) -> tuple[np.ndarray, np.ndarray]:
+        # Pieces of the given color, or of the side to move in each position when color is None
+        if (color is None):
+            return (np.where(self.turn, self.occupied_co[WHITE], self.occupied_co[BLACK]),
+                    np.where(self.turn, self.occupied_co[BLACK], self.occupied_co[WHITE]))
+        return self.occupied_co[color], self.occupied_co[not color]
+
+    def _attacks(self, ours: np.ndarray, white: np.ndarray, modality: int) -> np.ndarray:
+        empty = ~self.occupied
+        pawns = self.pawns & ours
+        attacks = np.where(white, _leap(pawns, PAWN_CAPTURE_DIRECTIONS[WHITE]), _leap(pawns, PAWN_CAPTURE_DIRECTIONS[BLACK]))
+        # The extra captures of the pawn type of each position, like CustomBoard.side_attacks_mask
+        for pawn_type in np.unique(self.pawn_types):
+            tables = PAWN_VARIANT_CAPTURE_TABLES.get(int(pawn_type))
+            if (tables is None):
+                continue
+            for side in (WHITE, BLACK):
+                selected = (self.pawn_types == pawn_type) & (white == side)
+                if (not selected.any()):
+                    continue
+                for from_mask, delta, file_mask in tables[side]:
+                    captures = _shift(pawns & U64(from_mask), delta) & U64(file_mask)
+                    attacks |= np.where(selected, captures, U64(0))
+        attacks |= _leap(self.knights & ours, KNIGHT_DIRECTIONS)
+        attacks |= _leap(self.kings & ours, KING_DIRECTIONS)
+        for direction in DIAGONAL_DIRECTIONS:
+            attacks |= _ride((self.bishops | self.queens) & ours, empty, direction, 0)
+        for direction in ORTHOGONAL_DIRECTIONS:
+            attacks |= _ride((self.rooks | self.queens) & ours, empty, direction, 0)
+        for betza, masks in self.custom_pieces.items():
+            pieces = masks & ours & ~self.pawns
+            if (pieces.any()):
+                attacks |= compiled_attacks(pieces, empty, compile_betza(betza), modality)
+        return attacks
+
+    def attacks(self, color: Optional[Color] = None) -> np.ndarray:
+        # Squares attacked by the given side (default: the side to move), own pieces included
+        ours, theirs = self._side(color)
+        white = self.turn if color is None else np.full(len(self), color)
+        return self._attacks(ours, white, MoveModality.MODALITY_CAPTURE)
+
+    def is_check(self) -> np.ndarray:
+        ours, theirs = self._side(None)
+        return (self.kings & ours & self._attacks(theirs, ~self.turn, MoveModality.MODALITY_CAPTURE)) != 0
+
+    def mobility(self, color: Optional[Color] = None) -> np.ndarray:
+        # Number of distinct squares the side can move to, ignoring pins, castling and en passant
+        ours, theirs = self._side(color)
+        white = self.turn if color is None else np.full(len(self), color)
+        empty = ~self.occupied
+        targets = self._attacks(ours, white, MoveModality.MODALITY_CAPTURE) & theirs
+        # Pawns and custom pieces move differently when they do not capture
+        quiet = self._attacks(ours & ~self.pawns, white, MoveModality.MODALITY_QUIET)
+        pawns = self.pawns & ours
+        single = np.where(white, _shift(pawns, 8), _shift(pawns, -8)) & empty
+        # Same masks as python-chess, which also lets pawns that stepped back to their first rank move twice
+        double = np.where(white, _shift(single, 8) & U64(BB_RANK_3 | BB_RANK_4), _shift(single, -8) & U64(BB_RANK_6 | BB_RANK_5)) & empty
+        targets |= (quiet | single | double) & empty
+
+        for pawn_type in np.unique(self.pawn_types):
+            if (pawn_type == 1):
+                continue
+            for side in (WHITE, BLACK):
+                selected = (self.pawn_types == pawn_type) & (white == side)
+                if (not selected.any()):
+                    continue
+                for rule_from, delta, file_mask, path, capture in PAWN_VARIANT_TABLES[int(pawn_type)][side]:
+                    sources = pawns & U64(rule_from)
+                    if (path):
+                        sources &= _shift(empty, -path)
+                    moves = _shift(sources, delta) & U64(file_mask) & (theirs if capture else empty)
+                    targets |= np.where(selected, moves, U64(0))
+        return np.bitwise_count(targets).astype(np.int32)
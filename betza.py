@@ -1,4 +1,7 @@
+import dataclasses
+import functools
 from piece import *
+from attacks import *
 
 leaper_atoms: dict[str, list[tuple]] = {
     'W': [(1, 0)],
@@ -21,32 +24,6 @@ rider_atoms: dict[str, list[tuple]] = {
 verticals = "fbvh"
 horizontals = "rlsh"
 
-def crooked_path(base: int, start: int, target: int, distance: int) -> list[int]:
-    if (target == start):
-        return []
-    base_y = int(round(base / 8))
-    base_x = base - base_y * 8
-    base_perp = -base_y + (base_x << 3)
-    path_straight = [(target & 7) - (start & 7), (target >> 3) - (start >> 3)]
-    step_para = path_straight[0] * base_x + path_straight[1] * base_y
-    step_perp = -path_straight[0] * base_y + path_straight[1] * base_x
-    determinant = base_x * base_x + base_y * base_y
-    if (step_para % determinant != 0 or step_perp % determinant != 0):
-        return []
-    step_para //= determinant
-    step_perp //= determinant
-    if (step_perp < 0):
-        step_perp = -step_perp
-        base_perp = base_y - (base_x << 3)
-    if (step_para != step_perp and step_para != step_perp + 1):
-        return []
-    if (step_para + step_perp > distance):
-        return []
-    path = [start]
-    for steps in range (1, step_para + step_perp + 1):
-        path.append(path[-1] + base if (steps % 2 == 1) else path[-1] + base_perp)
-    return path
-
 def from_betza(betza) -> PieceInfo:
     new_piece = PieceInfo()
     move_modalities = []
@@ -147,6 +124,84 @@ def from_betza(betza) -> PieceInfo:
             distance = 0            
     return new_piece
 
+# Compiled pieces are shared between every board and every square, so they must never be modified
+@dataclasses.dataclass(frozen=True)
+class CompiledPiece:
+    betza: str
+    steps: tuple[dict[int, int], ...]
+    slider: tuple[dict[int, int], ...]
+    hopper: tuple[dict[int, int], ...]
+    crooked: tuple[dict[int, int], ...]
+    step_attacks: tuple[tuple[int, ...], ...]
+    slider_attacks: tuple[tuple, ...]
+    hopper_attacks: tuple[tuple, ...]
+    crooked_attacks: tuple[tuple, ...]
+    # Squares from which the piece captures on a given square, for check detection
+    reverse_attacks: tuple
+    # Per square, every square whose occupancy can change attackers_mask for it
+    attack_lines: tuple[int, ...]
+
+    def attackers_mask(self, square: int, occupied: int) -> int:
+        steps, sliders, hoppers, crooked = self.reverse_attacks
+        return (steps[square] | rider_attacks(sliders, square, occupied) |
+                reverse_hopper_attacks(hoppers, square, occupied) | crooked_attacks(crooked, square, occupied))
+
+    def moves_mask(self, square: int, occupied: int) -> int:
+        # Quiet moves to empty squares and captures on occupied ones, what CustomBoard generates for the piece
+        quiet, capture = MoveModality.MODALITY_QUIET, MoveModality.MODALITY_CAPTURE
+        moves = (self.step_attacks[quiet][square] | rider_attacks(self.slider_attacks[quiet], square, occupied) |
+                 hopper_attacks(self.hopper_attacks[quiet], square, occupied) |
+                 crooked_attacks(self.crooked_attacks[quiet], square, occupied)) & ~occupied
+        moves |= (self.step_attacks[capture][square] | rider_attacks(self.slider_attacks[capture], square, occupied) |
+                  hopper_attacks(self.hopper_attacks[capture], square, occupied) |
+                  crooked_attacks(self.crooked_attacks[capture], square, occupied)) & occupied
+        return moves
+
+    def setwise_attacks(self, pieces: int, occupied: int, modality: int = MoveModality.MODALITY_CAPTURE) -> int:
+        # Union of the attacks of all the given pieces of this kind
+        return setwise_attacks(pieces, occupied, self.steps[modality], self.slider[modality],
+                               self.hopper[modality], self.crooked[modality])
+
+def _attack_lines(reverse_attacks: tuple) -> tuple[int, ...]:
+    # The attacker squares themselves, the rays of riders and hoppers and the crooked paths
+    steps, sliders, hoppers, crooked = reverse_attacks
+    lines = []
+    for square in SQUARES:
+        mask = steps[square] | rider_attacks(sliders, square, BB_EMPTY)
+        for direction, tables, rays in hoppers:
+            mask |= rays[square]
+        for source, path in crooked[square]:
+            mask |= source | path
+        lines.append(mask)
+    return tuple(lines)
+
+BETZA_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=BETZA_CACHE_SIZE)
+def compile_betza(betza: str) -> CompiledPiece:
+    # Every board and preview shares this bounded cache, so strings chosen by clients cannot pile up
+    piece_info = from_betza(betza)
+    crooked = tuple(crooked_tables(crooked) for crooked in piece_info.crooked)
+    captures = MoveModality.MODALITY_CAPTURE
+    reverse_attacks = (
+        leaper_table(-direction for direction in piece_info.steps[captures]),
+        rider_tables({-direction: distance for direction, distance in piece_info.slider[captures].items()}),
+        reverse_hopper_tables(piece_info.hopper[captures]),
+        reverse_crooked_tables(crooked[captures])
+    )
+    return CompiledPiece(
+        betza = betza,
+        steps = tuple(piece_info.steps),
+        slider = tuple(piece_info.slider),
+        hopper = tuple(piece_info.hopper),
+        crooked = tuple(piece_info.crooked),
+        step_attacks = tuple(leaper_table(steps.keys()) for steps in piece_info.steps),
+        slider_attacks = tuple(rider_tables(slider) for slider in piece_info.slider),
+        hopper_attacks = tuple(hopper_tables(hopper) for hopper in piece_info.hopper),
+        crooked_attacks = crooked,
+        reverse_attacks = reverse_attacks,
+        attack_lines = _attack_lines(reverse_attacks)
+    )
 
 
 # Testing
@@ -1,6 +1,12 @@
+import functools
+import struct
 from typing import Iterator
 from chess import *
+from chess import _BoardState
 from betza import *
+from attacks import *
+import zobrist
+from cache import LRUCache
 import chess.pgn as pgn
 import io
 
@@ -10,8 +16,123 @@ CUSTOM_PIECE_TYPES = [SERGEANT, CAPTAIN, COLONEL, COMMANDER, CORPORAL, GENERAL,
                       ZIGZAG, STORM, HORIZONTAL_ZIGZAG, VERTICAL_ZIGZAG, HORIZONTAL_SWIPER, VERTICAL_SWIPER] = range(1, 14)
 CUSTOM_PIECE_SYMBOLS = [None, None, '2', '3', '4', '5', '6', '7', '8', 'z', 's', 'h', 'v', 'h', 'v']
 
+# Default Betza definitions, for boards that were not given their own through add_custom_piece_type
 CUSTOM_BETZA = {}
 
+# Extra quiet moves of the pawn types from White's point of view: (ranks, step, square that must be empty on the way)
+PAWN_VARIANT_RULES = {
+    CUSTOM_PIECE_TYPES[SERGEANT]: [(range(4, 8), (0, -1), None)],
+    CUSTOM_PIECE_TYPES[CAPTAIN]: [(range(4, 8), (0, -1), None),
+                                  (range(0, 2), (-1, 2), (0, 1)), (range(0, 2), (1, 2), (0, 1))],
+    CUSTOM_PIECE_TYPES[COLONEL]: [(range(3, 8), (0, -1), None), ([6], (-1, 0), None), ([6], (1, 0), None),
+                                  (range(0, 3), (-1, 2), (0, 1)), (range(0, 3), (1, 2), (0, 1)), ([2], (0, 2), (0, 1))],
+    CUSTOM_PIECE_TYPES[COMMANDER]: [(range(0, 8), (0, -1), None),
+                                    (range(0, 2), (-1, 2), (0, 1)), (range(0, 2), (1, 2), (0, 1)), ([2], (0, 2), (0, 1))],
+    CUSTOM_PIECE_TYPES[CORPORAL]: [([0, 1, 2, 4, 5, 6, 7], (0, -1), None)],
+    CUSTOM_PIECE_TYPES[GENERAL]: [(range(3, 8), (0, -1), None), ([6], (-1, 0), None), ([6], (1, 0), None),
+                                  (range(0, 3), (-1, 2), None), (range(0, 3), (1, 2), None)],
+    CUSTOM_PIECE_TYPES[LIEUTENANT]: [(range(0, 8), (0, -1), None), ([1, 6], (-1, 0), None), ([1, 6], (1, 0), None)],
+}
+
+# Extra captures of the pawn types, same point of view: (ranks, step). These land on enemy pieces only.
+BACKWARD_PAWN_CAPTURES = [(range(0, 8), (-1, -1)), (range(0, 8), (1, -1))]
+PAWN_VARIANT_CAPTURES = {pawn_type: BACKWARD_PAWN_CAPTURES for pawn_type in PAWN_VARIANT_RULES
+                         if pawn_type not in (CUSTOM_PIECE_TYPES[CORPORAL], CUSTOM_PIECE_TYPES[LIEUTENANT])}
+
+def _shift(bb: Bitboard, delta: int) -> Bitboard:
+    return (bb << delta) & BB_ALL if (delta > 0) else bb >> -delta
+
+def _pawn_variant_table(rules, captures, color: Color) -> tuple[tuple[Bitboard, int, Bitboard, int, bool], ...]:
+    # Each rule becomes (from mask, square offset, target file mask, offset of the square that must be empty, capture)
+    table = []
+    sign = 1 if color == WHITE else -1
+    for ranks, (step_x, step_y), path, capture in ([rule + (False, ) for rule in rules] +
+                                                   [(ranks, step, None, True) for ranks, step in captures]):
+        from_mask = BB_EMPTY
+        for rank in ranks:
+            from_mask |= BB_RANKS[rank if color == WHITE else 7 - rank]
+        file_mask = BB_ALL & ~(BB_FILE_A if step_x > 0 else BB_FILE_H if step_x < 0 else BB_EMPTY)
+        table.append((from_mask, sign * step_y * 8 + step_x, file_mask, sign * path[1] * 8 + path[0] if path else 0, capture))
+    return tuple(table)
+
+PAWN_VARIANT_TABLES = {pawn_type: [_pawn_variant_table(rules, PAWN_VARIANT_CAPTURES.get(pawn_type, []), color)
+                                   for color in (BLACK, WHITE)]
+                       for pawn_type, rules in PAWN_VARIANT_RULES.items()}
+
+# The capture entries alone, (from mask, square offset, target file mask), for attack detection
+PAWN_VARIANT_CAPTURE_TABLES = {pawn_type: [tuple((from_mask, delta, file_mask)
+                                                 for from_mask, delta, file_mask, path, capture in table if capture)
+                                           for table in tables]
+                               for pawn_type, tables in PAWN_VARIANT_TABLES.items() if pawn_type in PAWN_VARIANT_CAPTURES}
+
+# Legal moves of recently seen positions, keyed by Zobrist hash and the active piece definitions
+LEGAL_MOVE_CACHE = LRUCache(maxsize=4096)
+
+# SAN spellings of the legal moves of recently seen positions, see CustomBoard.san_index()
+SAN_INDEX_CACHE = LRUCache(maxsize=4096)
+
+# Binary position layout for CustomBoard.to_bytes(): occupied and white bitboards, turn/chess960 flags,
+# castling rooks on the first and last rank, en passant square, clocks, gate slots and the number of custom types.
+# Nibbles 1-6 are the python-chess piece types, 7-15 index the custom piece types in play.
+POSITION_HEADER = struct.Struct(">QQBBBBHH4bB")
+POSITION_CUSTOM_CODE = 7
+POSITION_MAX_CUSTOM_TYPES = 16 - POSITION_CUSTOM_CODE
+
+# Parsed board parts of recently seen Musketeer FENs, see _parse_musketeer_board_fen()
+MUSKETEER_FEN_CACHE = LRUCache(maxsize=1024)
+
+# Letters of the custom pieces that can stand on the board; the digits of the pawn types are never placed
+CUSTOM_SYMBOL_TYPES = {symbol: CUSTOM_PIECE_SYMBOLS.index(symbol) for symbol in CUSTOM_PIECE_SYMBOLS
+                       if symbol is not None and symbol.isalpha()}
+
+def _parse_musketeer_board_fen(musketeer_fen: str):
+    # One pass over the black gating row, the eight ranks from the 8th down and the white gating row.
+    # Returns the standard piece bitboards, both colors, (custom type, mask) pairs and the gate slots.
+    pieces = [BB_EMPTY] * 7
+    occupied_co = [BB_EMPTY, BB_EMPTY]
+    custom = {}
+    gated_positions = [[-1, -1], [-1, -1]]
+    row = 0
+    file = 0
+    for char in musketeer_fen:
+        if (char == "/"):
+            if (0 < row < 9 and file != 8):
+                raise ValueError(f"expected 8 columns per row in musketeer fen: {musketeer_fen!r}")
+            row += 1
+            file = 0
+            continue
+        if (row == 0 or row == 9):
+            color = WHITE if row == 9 else BLACK
+            if (char.upper() in "SZ"):
+                gated_positions[color]["SZ".index(char.upper())] = file
+            elif (char != "*"):
+                raise ValueError(f"invalid character {char!r} in gating row of musketeer fen: {musketeer_fen!r}")
+            file += 1
+            if (file > 9):
+                raise ValueError(f"gating row too long in musketeer fen: {musketeer_fen!r}")
+            continue
+        if (char in "12345678"):
+            file += int(char)
+        else:
+            if (file >= 8):
+                raise ValueError(f"expected 8 columns per row in musketeer fen: {musketeer_fen!r}")
+            mask = BB_SQUARES[(8 - row) * 8 + file]
+            symbol = char.lower()
+            if (symbol in PIECE_SYMBOLS and symbol):
+                pieces[PIECE_SYMBOLS.index(symbol)] |= mask
+            elif (symbol in CUSTOM_SYMBOL_TYPES):
+                custom[CUSTOM_SYMBOL_TYPES[symbol]] = custom.get(CUSTOM_SYMBOL_TYPES[symbol], BB_EMPTY) | mask
+            else:
+                raise ValueError(f"invalid character {char!r} in musketeer fen: {musketeer_fen!r}")
+            occupied_co[char.isupper()] |= mask
+            file += 1
+        if (file > 8):
+            raise ValueError(f"expected 8 columns per row in musketeer fen: {musketeer_fen!r}")
+    if (row != 9):
+        raise ValueError(f"expected 10 rows (gating rows and 8 ranks) in musketeer fen: {musketeer_fen!r}")
+    return (tuple(pieces[PAWN:KING + 1]), occupied_co[WHITE], occupied_co[BLACK], tuple(custom.items()),
+            tuple(tuple(slots) for slots in gated_positions))
+
 CUSTOM_SAN_REGEX = re.compile(r"^([NBKRQSZ])?([a-h])?([1-8])?[\-x]?([a-h][1-8])(/?[SZVH])?(=?[nbrqkNBRQK])?[\+#]?\Z")
 
 def print_bb(bb_int: Bitboard):
@@ -22,10 +143,6 @@ def print_bb(bb_int: Bitboard):
             print(bb[(r << 3) + 7 - c], end = "")
         print()
 
-def direction_in_2d(direction: int):
-    dir_y = int(round(direction / 8))
-    return direction - dir_y * 8, dir_y
-
 
 
 class CustomPiece(Piece):
@@ -37,13 +154,6 @@ class CustomPiece(Piece):
         self.piece_type = type
         self.color = color
         self.betza = moveset
-        self.steps: list[dict[int, int]] = from_betza(moveset).steps
-        self.slider: list[dict[int, int]] = from_betza(moveset).slider
-        self.slider_initial: list[int] = []
-        self.hopper: list[dict[int, int]] = from_betza(moveset).hopper
-        self.hopper_initial: list[int] = []
-        self.crooked: list[dict[int, int]] = from_betza(moveset).crooked
-        self.crooked_initial: list[int] = []
 
     def symbol(self):
         symbol = typing.cast(str, CUSTOM_PIECE_SYMBOLS[self.piece_type])
@@ -52,14 +162,59 @@ class CustomPiece(Piece):
     @classmethod
     def from_symbol(cls, symbol: str) -> Piece:
         return cls(CUSTOM_PIECE_SYMBOLS.index(symbol.lower()), symbol.isupper())
+
+@functools.lru_cache(maxsize=1024)
+def shared_custom_piece(piece_type: CustomPieceType, color: Color, betza: str) -> CustomPiece:
+    # Board lookups hand out these shared instances; the moves come from CustomBoard.compiled_piece()
+    return CustomPiece(piece_type, color, betza)
+
     
+class _CustomBoardState(_BoardState):
+    def __init__(self, board: "CustomBoard") -> None:
+        super().__init__(board)
+        self.custom = (tuple(board.custom_pieces), tuple(board.custom_piece_types),
+                       tuple(tuple(slots) for slots in board.gated_positions), board._zobrist)
+        # Repetition history: the full key of this position and whether the move made from it can be undone
+        self.zobrist_hash = board.zobrist_hash()
+        self.irreversible = True
+
+    def restore(self, board: "CustomBoard") -> None:
+        super().restore(board)
+        custom_pieces, custom_piece_types, gated_positions, board._zobrist = self.custom
+
+        # Only squares whose custom piece changed need to be fixed in the mailbox
+        if (len(custom_pieces) == len(board.custom_pieces) and tuple(board.custom_piece_types) == custom_piece_types):
+            changed = BB_EMPTY
+            for old, new in zip(custom_pieces, board.custom_pieces):
+                changed |= old ^ new
+        else:
+            changed = BB_ALL
+        board.custom_pieces = list(custom_pieces)
+        board.custom_piece_types = list(custom_piece_types)
+        for square in scan_forward(changed):
+            board.custom_mailbox[square] = None
+        for index in range (len(custom_pieces)):
+            for square in scan_forward(custom_pieces[index] & changed):
+                board.custom_mailbox[square] = custom_piece_types[index]
+
+        board.gated_positions = [list(slots) for slots in gated_positions]
+
 class CustomBoard(Board):
     custom_pieces: list[Bitboard] = []
     custom_piece_types: list[CustomPieceType] = []
     gated_positions: list[list[int]] = [[-1, -1], [-1, -1]]
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, fen: Optional[str] = STARTING_FEN, *, chess960: bool = False):
+        self.custom_pieces = []
+        self.custom_piece_types = []
+        self.gated_positions = [[-1, -1], [-1, -1]]
+        # Betza definitions of this board's custom piece types, ahead of the CUSTOM_BETZA defaults
+        self.piece_betza: dict[CustomPieceType, str] = {}
+        # Square-indexed custom piece types, kept in sync with custom_pieces
+        self.custom_mailbox: list[Optional[CustomPieceType]] = [None] * 64
+        # Zobrist key of the piece placement, see zobrist_hash()
+        self._zobrist = 0
+        super().__init__(fen, chess960=chess960)
 
     def __str__(self) -> str:
         builder = []
@@ -86,25 +241,40 @@ class CustomBoard(Board):
         black_back_row[self.gated_positions[BLACK][1]] = 'z'
         return ' '.join(black_back_row)[:15] + '\n' + "".join(builder) + '\n' + ' '.join(white_back_row)[:15]
     
+    def add_custom_piece_type(self, piece_type: CustomPieceType, betza: Optional[str] = None) -> None:
+        if (betza is not None):
+            self.piece_betza[piece_type] = betza
+        if (self.custom_piece_types.count(piece_type) == 0):
+            self.custom_pieces.append(BB_EMPTY)
+            self.custom_piece_types.append(piece_type)
+
+    def set_piece_definitions(self, definitions: Iterable[tuple[CustomPieceType, Optional[str]]]) -> None:
+        # Definitions that came with a position (another process, a database row, a token)
+        for piece_type, betza in definitions:
+            if (betza is not None):
+                self.piece_betza[piece_type] = betza
+
+    def betza_of(self, piece_type: CustomPieceType) -> Optional[str]:
+        betza = self.piece_betza.get(piece_type)
+        return betza if betza is not None else CUSTOM_BETZA.get(piece_type)
+
+    def compiled_piece(self, piece_type: CustomPieceType) -> CompiledPiece:
+        return compile_betza(self.betza_of(piece_type) or "")
+
     def custom_piece_type_at(self, square: Square) -> Optional[CustomPieceType]:
-        mask = BB_SQUARES[square]
-        if (not self.occupied & mask):
-            return None
-        for index in range (len(self.custom_pieces)):
-            if (self.custom_pieces[index] & mask):
-                return self.custom_piece_types[index]
-        return None
+        return self.custom_mailbox[square]
+
     def custom_piece_at(self, square: Square) -> Optional[CustomPiece]:
-        piece_type = self.custom_piece_type_at(square)
+        piece_type = self.custom_mailbox[square]
         if piece_type:
             mask = BB_SQUARES[square]
             color = bool(self.occupied_co[WHITE] & mask)
-            return CustomPiece(piece_type, color, CUSTOM_BETZA[piece_type])
+            return shared_custom_piece(piece_type, color, self.betza_of(piece_type) or "")
         else:
             return None
 
     def remove_custom_piece_at(self, square: Square) -> Optional[CustomPieceType]:
-        piece_type = self.custom_piece_type_at(square)
+        piece_type = self.custom_mailbox[square]
         if (piece_type == None):
             return None
         mask = BB_SQUARES[square]
@@ -112,6 +282,8 @@ class CustomBoard(Board):
         for index in range (len(self.custom_pieces)):
             if (piece_type == self.custom_piece_types[index]):
                 self.custom_pieces[index] ^= mask
+        self.custom_mailbox[square] = None
+        self._zobrist ^= zobrist.custom_piece_key(piece_type, bool(self.occupied_co[WHITE] & mask), square)
 
         self.occupied ^= mask
         self.occupied_co[WHITE] &= ~mask
@@ -122,7 +294,8 @@ class CustomBoard(Board):
         return piece_type
 
     def set_custom_piece_at(self, square: Square, piece: Optional[CustomPiece], promoted: bool = False):
-        self.remove_custom_piece_at(square)
+        if (self.remove_custom_piece_at(square) == None):
+            self._remove_piece_at(square)
         if (piece == None):
             return
         mask = BB_SQUARES[square]
@@ -130,252 +303,253 @@ class CustomBoard(Board):
         for index in range (len(self.custom_pieces)):
             if (piece.piece_type == self.custom_piece_types[index]):
                 self.custom_pieces[index] |= mask
+        self.custom_mailbox[square] = piece.piece_type
+        self._zobrist ^= zobrist.custom_piece_key(piece.piece_type, piece.color, square)
         self.occupied ^= mask
         self.occupied_co[piece.color] ^= mask
         if promoted:
             self.promoted ^= mask
-    
-    def clear_board(self):
-        super().clear_board()
-        for custom_bb in self.custom_pieces:
-            custom_bb = BB_EMPTY
+
+    def _remove_piece_at(self, square: Square) -> Optional[PieceType]:
+        if (self.custom_mailbox[square] != None):
+            self.remove_custom_piece_at(square)
+            return None
+        color = bool(self.occupied_co[WHITE] & BB_SQUARES[square])
+        piece_type = super()._remove_piece_at(square)
+        if piece_type:
+            self._zobrist ^= zobrist.piece_key(piece_type, color, square)
+        return piece_type
+
+    def _set_piece_at(self, square: Square, piece_type: PieceType, color: Color, promoted: bool = False) -> None:
+        super()._set_piece_at(square, piece_type, color, promoted)
+        if (piece_type in PIECE_TYPES):
+            self._zobrist ^= zobrist.piece_key(piece_type, color, square)
+
+    def _clear_custom_pieces(self) -> None:
+        for index in range (len(self.custom_pieces)):
+            self.custom_pieces[index] = BB_EMPTY
+        self.custom_mailbox = [None] * 64
+
+    def _clear_board(self) -> None:
+        super()._clear_board()
+        self._clear_custom_pieces()
+        self._zobrist = 0
+
+    def _reset_board(self) -> None:
+        super()._reset_board()
+        self._clear_custom_pieces()
+        self._zobrist = zobrist.placement_key(self)
+
+    def zobrist_hash(self) -> int:
+        # Pieces are hashed incrementally, the few remaining state keys are added on demand
+        return self._zobrist ^ zobrist.state_key(self.turn, self.castling_rights, zobrist.legal_ep_square(self), self.gated_positions)
 
     def is_slide_path(self, direction: int, start: Square, target: Square, distance: int) -> bool:
-        dir_x, dir_y = direction_in_2d(direction)
-        path_x = (target & 7) - (start & 7)
-        path_y = (target >> 3) - (start >> 3)
-        if ((dir_x == 0 and path_x != 0) or (dir_y == 0 and path_y != 0)):
-            return False
-        if ((dir_x != 0 and path_x % dir_x != 0) or (dir_y != 0 and path_y % dir_y != 0)):
+        masks, attacks = rider_attack_table((direction, ), distance)
+        if (not attacks[start][masks[start] & self.occupied] & BB_SQUARES[target]):
             return False
-        if (dir_x != 0 and dir_y != 0 and path_x // dir_x != path_y // dir_y):
-            return False
-        if ((dir_x != 0 and abs(path_x // dir_x) > distance) or (dir_y != 0 and abs(path_y // dir_y) > distance)):
-            return False
-        current = start
-        for step in range (path_x // dir_x if (dir_x != 0) else path_y // dir_y):
-            current += direction
-            if (current != target and BB_SQUARES[current] & self.occupied):
-                return False
-        return not BB_SQUARES[current] & self.occupied_co[self.turn]
+        return not BB_SQUARES[target] & self.occupied_co[self.turn]
 
     def is_hop_path(self, direction: int, start: Square, target: Square, distance: int) -> bool:
-        return False
+        tables = hopper_tables({direction: distance})
+        if (not hopper_attacks(tables, start, self.occupied) & BB_SQUARES[target]):
+            return False
+        return not BB_SQUARES[target] & self.occupied_co[self.turn]
 
     def is_crooked_path(self, direction: int, start: Square, target: Square, distance: int) -> bool:
-        if (target == start):
-            return False
-        direction_x, direction_y = direction_in_2d(direction)
-        direction_perp = -direction_y + (direction_x << 3)
-        path_straight = [(target & 7) - (start & 7), (target >> 3) - (start >> 3)]
-        step_para = path_straight[0] * direction_x + path_straight[1] * direction_y
-        step_perp = -path_straight[0] * direction_y + path_straight[1] * direction_x
-        determinant = direction_x * direction_x + direction_y * direction_y
-        if (step_para % determinant != 0 or step_perp % determinant != 0):
-            return False
-        step_para //= determinant
-        step_perp //= determinant
-        if (step_perp < 0):
-            step_perp = -step_perp
-            direction_perp = direction_y - (direction_x << 3)
-        if (step_para != step_perp and step_para != step_perp + 1):
+        path = crooked_path_table(direction, distance)[start].get(target)
+        if (path is None or path & self.occupied):
             return False
-        if (step_para + step_perp > distance):
-            return False
-        current = start
-        for step in range (1, step_para + step_perp + 1):
-            current += direction if (step % 2 == 1) else direction_perp
-            if (current != target and BB_SQUARES[current] & self.occupied):
-                return False
         return not BB_SQUARES[target] & self.occupied_co[self.turn]
 
     def crooked_path(self, direction: int, start: Square, target: Square, distance: int) -> Bitboard:
         if (not self.is_crooked_path(direction, start, target, distance)):
             return BB_EMPTY
-        direction_x, direction_y = direction_in_2d(direction)
-        direction_perp = -direction_y + (direction_x << 3)
-        path_straight = [(target & 7) - (start & 7), (target >> 3) - (start >> 3)]
-        step_para = path_straight[0] * direction_x + path_straight[1] * direction_y
-        step_perp = -path_straight[0] * direction_y + path_straight[1] * direction_x
-        determinant = direction_x * direction_x + direction_y * direction_y
-        step_para //= determinant
-        step_perp //= determinant
-        if (step_perp < 0):
-            step_perp = -step_perp
-            direction_perp = direction_y - (direction_x << 3)
-        current = start
-        bb_path = BB_EMPTY
-        for step in range (1, step_para + step_perp + 1):
-            current += direction if (step % 2 == 1) else direction_perp
-            bb_path |= BB_SQUARES[current]
-        return bb_path
-    
-    def custom_attacks_mask(self, square: Square) -> Bitboard:
-        bb_square = BB_SQUARES[square]
-        attacks = BB_EMPTY
-        for ind in range (len(self.custom_pieces)):
-            piece = self.custom_piece_at(square)
-            for dir in piece.steps[0].keys():
-                for to_sq in SQUARES:
-                    if (self.is_slide_path(dir, square, to_sq, 1) and not BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-            for dir in piece.steps[1].keys():
-                for to_sq in SQUARES:
-                    if (self.is_slide_path(dir, square, to_sq, 1) and BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-
-            for dir, dist in piece.slider[0].items():
-                for to_sq in SQUARES:
-                    if (self.is_slide_path(dir, square, to_sq, dist) and not BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-            for dir, dist in piece.slider[1].items():
-                for to_sq in SQUARES:
-                    if (self.is_slide_path(dir, square, to_sq, dist) and BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-
-            for dir, dist in piece.crooked[0].items():
-                for to_sq in SQUARES:
-                    if (self.is_crooked_path(dir, square, to_sq, dist) and not BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-            for dir, dist in piece.crooked[1].items():
-                for to_sq in SQUARES:
-                    if (self.is_crooked_path(dir, square, to_sq, dist) and BB_SQUARES[to_sq] & self.occupied):
-                        attacks |= (BB_SQUARES[to_sq])
-        return attacks
+        return crooked_path_table(direction, distance)[start][target] | BB_SQUARES[target]
+
+    def custom_pawn_type(self) -> CustomPieceType:
+        # The first pawn type in play replaces the standard pawn, 1 means standard pawns
+        for pawn_type in range(CUSTOM_PIECE_TYPES[SERGEANT], CUSTOM_PIECE_TYPES[LIEUTENANT] + 1):
+            if (self.custom_piece_types.count(pawn_type) != 0):
+                return pawn_type
+        return 1
 
-    # Custom moves from Betza notation
-    def generate_custom_moves_from_betza(self, piece: CustomPiece, from_square: int) -> list[Square]:
-        possible_moves = []
-        for index, (direction, distance) in piece.steps[0]:
-            for dist in range (1, max(1, distance)):
-                to_square = from_square + direction * dist
-                if (True):
-                    possible_moves.append(to_square)
-        return possible_moves
-
-    #Pseudo-legal moves of a custom piece
-    def generate_custom_pseudo_legal_moves(self, piece: CustomPiece, from_square: int, to_mask: Bitboard):
-        possible_moves = self.generate_custom_moves_from_betza(piece, from_square)
-        for to_square in possible_moves:
-            if self.piece_at(to_square) is None or self.piece_at(to_square).color != self.turn:
-                if BB_SQUARES[to_square] & to_mask:
-                    yield Move(from_square, to_square)
-    
     def generate_pseudo_legal_moves(self, from_mask: Bitboard = BB_ALL, to_mask: Bitboard = BB_ALL) -> Iterator[Move]:
         our_pieces = self.occupied_co[self.turn]
         
         # Handle non-pawn custom
-        non_pawn_custom = our_pieces & ~self.pawns & from_mask
+        non_pawn_custom = BB_EMPTY
         for custom in self.custom_pieces:
-            non_pawn_custom &= custom
+            non_pawn_custom |= custom
+        non_pawn_custom &= our_pieces & ~self.pawns & from_mask
         for from_square in scan_reversed(non_pawn_custom):
-            moves = self.custom_attacks_mask(from_square) & ~our_pieces & to_mask
+            moves = self.compiled_piece(self.custom_mailbox[from_square]).moves_mask(from_square, self.occupied)
+            moves &= ~our_pieces & to_mask
             for to_square in scan_reversed(moves):
                 yield Move(from_square, to_square)
 
         # Handle pawn custom
         pawns = self.pawns & self.occupied_co[self.turn] & from_mask
 
-        pawn_type = 1
-        for temp_type in range(CUSTOM_PIECE_TYPES[SERGEANT], CUSTOM_PIECE_TYPES[LIEUTENANT] + 1):
-            if (self.custom_piece_types.count(temp_type) != 0 and pawn_type == 1):
-                pawn_type = temp_type
-
+        pawn_type = self.custom_pawn_type()
         if (pawn_type == 1):
             yield from super().generate_pseudo_legal_moves(from_mask, to_mask)
             return
 
-        # Special pawn captures
-        if (pawn_type != CUSTOM_PIECE_TYPES[CORPORAL] and pawn_type != CUSTOM_PIECE_TYPES[LIEUTENANT]):
-            for from_square in scan_reversed(pawns):
-                targets = BB_PAWN_ATTACKS[not self.turn][from_square] & self.occupied_co[not self.turn] & to_mask
-
-                for to_square in scan_reversed(targets):
-                    yield Move(from_square, to_square)
-
-        # Horizontal pawn moves
-        if (pawn_type == CUSTOM_PIECE_TYPES[COLONEL] or pawn_type == CUSTOM_PIECE_TYPES[GENERAL] or pawn_type == CUSTOM_PIECE_TYPES[LIEUTENANT]):
-            if (self.turn == WHITE):
-                for from_square in scan_reversed(pawns):
-                    if (square_rank(from_square) == 6 or (pawn_type == CUSTOM_PIECE_TYPES[LIEUTENANT] and square_rank(from_square) == 1)):
-                        if (BB_SQUARES[from_square + 1] & ~self.occupied and square_distance(from_square, from_square + 1) == 1):
-                            yield Move(from_square, from_square + 1)
-                        if (BB_SQUARES[from_square - 1] & ~self.occupied and square_distance(from_square, from_square - 1) == 1):
-                            yield Move(from_square, from_square - 1)
-            else:
-                for from_square in scan_reversed(pawns):
-                    if (square_rank(from_square) == 1 or (pawn_type == CUSTOM_PIECE_TYPES[LIEUTENANT] and square_rank(from_square) == 6)):
-                        if (BB_SQUARES[from_square + 1] & ~self.occupied and square_distance(from_square, from_square + 1) == 1):
-                            yield Move(from_square, from_square + 1)
-                        if (BB_SQUARES[from_square - 1] & ~self.occupied and square_distance(from_square, from_square - 1) == 1):
-                            yield Move(from_square, from_square - 1)
-
-        # Backward pawn moves
-        for from_square in scan_reversed(pawns):
-            if (self.turn == WHITE):
-                if ((pawn_type == CUSTOM_PIECE_TYPES[SERGEANT] or pawn_type == CUSTOM_PIECE_TYPES[CAPTAIN]) and square_rank(from_square) < 4):
-                    continue
-                if ((pawn_type == CUSTOM_PIECE_TYPES[COLONEL] or pawn_type == CUSTOM_PIECE_TYPES[GENERAL]) and square_rank(from_square) < 3):
-                    continue
-                if (pawn_type == CUSTOM_PIECE_TYPES[CORPORAL] and square_rank(from_square) == 3):
-                    continue
-                yield Move(from_square, from_square - 8)
+        # Extra pawn moves and captures, all pawns at once; the base class adds the forward ones
+        empty = ~self.occupied & BB_ALL
+        theirs = self.occupied_co[not self.turn]
+        for rule_from, delta, file_mask, path, capture in PAWN_VARIANT_TABLES[pawn_type][self.turn]:
+            sources = pawns & rule_from
+            if (path):
+                sources &= _shift(empty, -path)
+            for to_square in scan_reversed(_shift(sources, delta) & file_mask & (theirs if capture else empty) & to_mask):
+                yield Move(to_square - delta, to_square)
 
-            else:
-                if ((pawn_type == CUSTOM_PIECE_TYPES[SERGEANT] or pawn_type == CUSTOM_PIECE_TYPES[CAPTAIN]) and square_rank(from_square) > 3):
-                    continue
-                if ((pawn_type == CUSTOM_PIECE_TYPES[COLONEL] or pawn_type == CUSTOM_PIECE_TYPES[GENERAL]) and square_rank(from_square) > 4):
-                    continue
-                if (pawn_type == CUSTOM_PIECE_TYPES[CORPORAL] and square_rank(from_square) == 4):
-                    continue
-                yield Move(from_square, from_square + 8)
-
-        # Knight pawn moves
-        if (pawn_type == CUSTOM_PIECE_TYPES[CAPTAIN] or pawn_type == CUSTOM_PIECE_TYPES[COLONEL] or pawn_type == CUSTOM_PIECE_TYPES[COMMANDER] or pawn_type == CUSTOM_PIECE_TYPES[GENERAL]):
-            if (self.turn == WHITE):
-                for from_square in scan_reversed(pawns):
-                    if (square_rank(from_square) > 2):
-                        break
-                    if ((pawn_type == CUSTOM_PIECE_TYPES[CAPTAIN] or pawn_type == CUSTOM_PIECE_TYPES[COMMANDER]) and square_rank(from_square) > 1):
-                        break
-                    if (pawn_type != CUSTOM_PIECE_TYPES[GENERAL] and BB_SQUARES[from_square + 8] & self.occupied):
-                        break
-                    if (square_distance(from_square, from_square + 15) == 2 and BB_SQUARES[from_square + 15] & ~self.occupied):
-                        yield Move(from_square, from_square + 15)
-                    if (square_distance(from_square, from_square + 17) == 2 and BB_SQUARES[from_square + 17] & ~self.occupied):
-                        yield Move(from_square, from_square + 17)
+        yield from super().generate_pseudo_legal_moves(from_mask, to_mask)
+    
+    def custom_type_attacks(self, piece_type: CustomPieceType, color: Color,
+                            modality: int = MoveModality.MODALITY_CAPTURE) -> Bitboard:
+        # Squares attacked by all pieces of one custom type at once, own pieces included
+        if (piece_type not in self.custom_piece_types):
+            return BB_EMPTY
+        pieces = self.custom_pieces[self.custom_piece_types.index(piece_type)] & self.occupied_co[color] & ~self.pawns
+        if (not pieces):
+            return BB_EMPTY
+        return self.compiled_piece(piece_type).setwise_attacks(pieces, self.occupied, modality)
 
-            else:
-                for from_square in scan_reversed(pawns):
-                    if (square_rank(from_square) < 5):
-                        break
-                    if ((pawn_type == CUSTOM_PIECE_TYPES[CAPTAIN] or pawn_type == CUSTOM_PIECE_TYPES[COMMANDER]) and square_rank(from_square) < 6):
-                        break
-                    if (pawn_type != CUSTOM_PIECE_TYPES[GENERAL] and BB_SQUARES[from_square - 8] & self.occupied):
-                        break
-                    if (square_distance(from_square, from_square - 15) == 2 and BB_SQUARES[from_square - 15] & ~self.occupied):
-                        yield Move(from_square, from_square - 15)
-                    if (square_distance(from_square, from_square - 17) == 2 and BB_SQUARES[from_square - 17] & ~self.occupied):
-                        yield Move(from_square, from_square - 17)
-
-        # Double pawn moves on 3rd rank
-        if (pawn_type == CUSTOM_PIECE_TYPES[COLONEL] or pawn_type == CUSTOM_PIECE_TYPES[COMMANDER]):
-            double_moves = pawns
-            if (self.turn == WHITE):
-                double_moves = (double_moves << 8) & ~self.occupied
-                double_moves = double_moves << 8 & ~self.occupied & (BB_RANK_4 | BB_RANK_5)
-            else:
-                double_moves = (double_moves >> 8) & ~self.occupied
-                double_moves = double_moves >> 8 & ~self.occupied & (BB_RANK_5 | BB_RANK_4)
+    def side_attacks_mask(self, color: Color) -> Bitboard:
+        # Every square attacked by a side, for king safety, mobility and "is any of these squares attacked"
+        ours = self.occupied_co[color]
+        empty = ~self.occupied & BB_ALL
+        attacks = BB_EMPTY
+        for direction in PAWN_CAPTURE_DIRECTIONS[color]:
+            attacks |= shift_step(self.pawns & ours, direction)
+        tables = PAWN_VARIANT_CAPTURE_TABLES.get(self.custom_pawn_type())
+        if (tables is not None):
+            for from_mask, delta, file_mask in tables[color]:
+                attacks |= _shift(self.pawns & ours & from_mask, delta) & file_mask
+        for direction in KNIGHT_DIRECTIONS:
+            attacks |= shift_step(self.knights & ours, direction)
+        for direction in KING_DIRECTIONS:
+            attacks |= shift_step(self.kings & ours, direction)
+        diagonal = (self.bishops | self.queens) & ours
+        orthogonal = (self.rooks | self.queens) & ours
+        if (diagonal):
+            for direction in DIAGONAL_DIRECTIONS:
+                attacks |= occluded_fill(diagonal, empty, direction)
+        if (orthogonal):
+            for direction in ORTHOGONAL_DIRECTIONS:
+                attacks |= occluded_fill(orthogonal, empty, direction)
+        for piece_type in self.custom_piece_types:
+            attacks |= self.custom_type_attacks(piece_type, color)
+        return attacks
 
-            double_moves &= to_mask
-            for to_square in scan_reversed(double_moves):
-                from_square = to_square + (16 if self.turn == BLACK else -16)
-                yield Move(from_square, to_square)
+    def is_any_attacked_by(self, color: Color, mask: Bitboard) -> bool:
+        return bool(self.side_attacks_mask(color) & mask)
 
-        yield from super().generate_pseudo_legal_moves(from_mask, to_mask)
-    
-    def generate_legal_moves(self, from_mask: Bitboard = BB_ALL, to_mask: Bitboard = BB_ALL):
+    def custom_mask(self) -> Bitboard:
+        mask = BB_EMPTY
+        for custom in self.custom_pieces:
+            mask |= custom
+        return mask
+
+    def _custom_attackers_mask(self, color: Color, square: Square, occupied: Bitboard) -> Bitboard:
+        attackers = BB_EMPTY
+        for index in range (len(self.custom_pieces)):
+            pieces = self.custom_pieces[index] & self.occupied_co[color]
+            if (pieces):
+                piece_type = self.custom_piece_types[index]
+                attackers |= self.compiled_piece(piece_type).attackers_mask(square, occupied) & pieces
+        return attackers
+
+    def _custom_attack_lines(self, color: Color, square: Square) -> Bitboard:
+        # Squares where a change of occupancy can let a custom piece of this color attack the square
+        lines = BB_EMPTY
+        for index in range (len(self.custom_pieces)):
+            if (self.custom_pieces[index] & self.occupied_co[color]):
+                lines |= self.compiled_piece(self.custom_piece_types[index]).attack_lines[square]
+        return lines
+
+    def _pawn_variant_attackers_mask(self, color: Color, square: Square) -> Bitboard:
+        # Pawns of this color that capture onto the square with the extra captures of the pawn type in play
+        tables = PAWN_VARIANT_CAPTURE_TABLES.get(self.custom_pawn_type())
+        if (tables is None):
+            return BB_EMPTY
+        pawns = self.pawns & self.occupied_co[color]
+        target = BB_SQUARES[square]
+        attackers = BB_EMPTY
+        for from_mask, delta, file_mask in tables[color]:
+            attackers |= _shift(target & file_mask, -delta) & from_mask & pawns
+        return attackers
+
+    def _attackers_mask(self, color: Color, square: Square, occupied: Bitboard) -> Bitboard:
+        return (super()._attackers_mask(color, square, occupied) | self._custom_attackers_mask(color, square, occupied) |
+                self._pawn_variant_attackers_mask(color, square))
+
+    def _is_safe_after(self, king: Square, move: Move) -> bool:
+        # Exact test on the occupancy after the move, for positions where custom pieces give check
+        if (self.is_castling(move)):
+            return True
+        captured = BB_SQUARES[move.to_square]
+        if (self.is_en_passant(move)):
+            captured = BB_SQUARES[move.to_square + (-8 if self.turn == WHITE else 8)]
+        occupied = (self.occupied & ~BB_SQUARES[move.from_square] & ~captured) | BB_SQUARES[move.to_square]
+        king_square = move.to_square if (move.from_square == king) else king
+        return not self._attackers_mask(not self.turn, king_square, occupied) & ~captured
+
+    def _is_safe(self, king: Square, blockers: Bitboard, move: Move) -> bool:
+        if (not self.custom_mask() & self.occupied_co[not self.turn]):
+            return super()._is_safe(king, blockers, move)
+        # The king itself may be the screen of a hopper, so king moves always get the exact test
+        if (move.from_square == king):
+            return self._is_safe_after(king, move)
+        if (not super()._is_safe(king, blockers, move)):
+            return False
+        # The standard pieces were covered above, only the custom ones still need the occupancy after the move.
+        # No custom piece gives check here, so a move away from their lines to the king cannot expose it
+        captured = BB_SQUARES[move.to_square]
+        if (self.is_en_passant(move)):
+            captured = BB_SQUARES[move.to_square + (-8 if self.turn == WHITE else 8)]
+        if (not (BB_SQUARES[move.from_square] | BB_SQUARES[move.to_square] | captured) & self._custom_attack_lines(not self.turn, king)):
+            return True
+        occupied = (self.occupied & ~BB_SQUARES[move.from_square] & ~captured) | BB_SQUARES[move.to_square]
+        return not self._custom_attackers_mask(not self.turn, king, occupied) & ~captured
+
+    def piece_definitions(self) -> tuple[tuple[CustomPieceType, Optional[str]], ...]:
+        # The definitions move generation reads, which is why they are part of the legal move cache key
+        return tuple((piece_type, self.betza_of(piece_type)) for piece_type in self.custom_piece_types)
+
+    def _legal_move_key(self) -> tuple:
+        return (self.zobrist_hash(), self.chess960, self.piece_definitions())
+
+    def legal_move_list(self) -> tuple[Move, ...]:
+        key = self._legal_move_key()
+        moves = LEGAL_MOVE_CACHE.get(key)
+        if (moves is None):
+            moves = tuple(self._generate_legal_moves())
+            LEGAL_MOVE_CACHE.put(key, moves)
+        return moves
+
+    def legal_move_map(self) -> dict[Square, list[Square]]:
+        # Target squares of every piece that can move, the four promotions of a pawn counting once
+        move_map: dict[Square, list[Square]] = {}
+        for move in self.legal_move_list():
+            targets = move_map.setdefault(move.from_square, [])
+            if (move.to_square not in targets):
+                targets.append(move.to_square)
+        return move_map
+
+    def generate_legal_moves(self, from_mask: Bitboard = BB_ALL, to_mask: Bitboard = BB_ALL) -> Iterator[Move]:
+        moves = self.legal_move_list()
+        if (from_mask == BB_ALL and to_mask == BB_ALL):
+            yield from moves
+            return
+        for move in moves:
+            if (BB_SQUARES[move.from_square] & from_mask and BB_SQUARES[move.to_square] & to_mask):
+                yield move
+
+    def _generate_legal_moves(self, from_mask: Bitboard = BB_ALL, to_mask: Bitboard = BB_ALL) -> Iterator[Move]:
         if self.is_variant_end():
             return
 
@@ -384,7 +558,12 @@ class CustomBoard(Board):
             king = msb(king_mask)
             blockers = self._slider_blockers(king)
             checkers = self.attackers_mask(not self.turn, king)
-            if checkers:
+            if (checkers & self.custom_mask()):
+                # Evasions only know how to block lines, so test every move against custom checkers
+                for move in self.generate_pseudo_legal_moves(from_mask, to_mask):
+                    if self._is_safe_after(king, move):
+                        yield move
+            elif checkers:
                 for move in self._generate_evasions(king, checkers, from_mask, to_mask):
                     if self._is_safe(king, blockers, move):
                         yield move
@@ -396,23 +575,187 @@ class CustomBoard(Board):
             yield from self.generate_pseudo_legal_moves(from_mask, to_mask)
 
     def set_musketeer_board_fen(self, musketeer_fen: str) -> None:
-        rows = musketeer_fen.split("/")
-        fen = "/".join(rows[1:9])
-        super().set_board_fen(fen)
-        for ind in range (len(rows[9])):
-            square = rows[9][ind]
-            if (square == 'S'):
-                self.gated_positions[WHITE][0] = ind
-            elif (square == 'Z'):
-                self.gated_positions[WHITE][1] = ind
-        for ind in range (len(rows[0])):
-            square = rows[0][ind]
-            if (square == 's'):
-                self.gated_positions[BLACK][0] = ind
-            elif (square == 'z'):
-                self.gated_positions[BLACK][1] = ind
+        parsed = MUSKETEER_FEN_CACHE.get(musketeer_fen)
+        if (parsed is None):
+            parsed = _parse_musketeer_board_fen(musketeer_fen)
+            MUSKETEER_FEN_CACHE.put(musketeer_fen, parsed)
+        pieces, white, black, custom, gated_positions = parsed
+        for piece_type, mask in custom:
+            if (self.betza_of(piece_type) is None):
+                raise ValueError(f"no betza for custom piece {CUSTOM_PIECE_SYMBOLS[piece_type]!r} in musketeer fen: {musketeer_fen!r}")
+
+        self._clear_board()
+        self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings = pieces
+        self.occupied_co[WHITE] = white
+        self.occupied_co[BLACK] = black
+        self.occupied = white | black
+        for piece_type, mask in custom:
+            self.add_custom_piece_type(piece_type)
+            self.custom_pieces[self.custom_piece_types.index(piece_type)] = mask
+            for square in scan_forward(mask):
+                self.custom_mailbox[square] = piece_type
+        self.gated_positions = [list(slots) for slots in gated_positions]
+        self._zobrist = zobrist.placement_key(self)
+        self.clear_stack()
+
+    def set_musketeer_fen(self, musketeer_fen: str) -> None:
+        # The board part is followed by the usual FEN fields, which may be left out like in set_fen
+        parts = musketeer_fen.split()
+        if (not parts):
+            raise ValueError("empty musketeer fen")
+        if (len(parts) > 6):
+            raise ValueError(f"musketeer fen has more parts than expected: {musketeer_fen!r}")
+        board_part, turn_part, castling_part, ep_part, halfmove_part, fullmove_part = parts + ["w", "-", "-", "0", "1"][len(parts) - 1:]
+
+        if (turn_part not in ("w", "b")):
+            raise ValueError(f"expected 'w' or 'b' for turn part of musketeer fen: {musketeer_fen!r}")
+        if (not FEN_CASTLING_REGEX.match(castling_part)):
+            raise ValueError(f"invalid castling part in musketeer fen: {musketeer_fen!r}")
+        try:
+            ep_square = None if ep_part == "-" else SQUARE_NAMES.index(ep_part)
+            halfmove_clock = int(halfmove_part)
+            fullmove_number = int(fullmove_part)
+        except ValueError:
+            raise ValueError(f"invalid en passant or move counters in musketeer fen: {musketeer_fen!r}")
+        if (halfmove_clock < 0 or fullmove_number < 1):
+            raise ValueError(f"invalid move counters in musketeer fen: {musketeer_fen!r}")
+
+        self.set_musketeer_board_fen(board_part)
+        self.turn = turn_part == "w"
+        self._set_castling_fen(castling_part)
+        self.ep_square = ep_square
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.clear_stack()
+
+    def musketeer_board_fen(self) -> str:
+        symbols = [None] * 64
+        for piece_type, mask in ((PAWN, self.pawns), (KNIGHT, self.knights), (BISHOP, self.bishops),
+                                 (ROOK, self.rooks), (QUEEN, self.queens), (KING, self.kings)):
+            for square in scan_forward(mask):
+                symbols[square] = PIECE_SYMBOLS[piece_type]
+        for piece_type, mask in zip(self.custom_piece_types, self.custom_pieces):
+            for square in scan_forward(mask):
+                symbols[square] = CUSTOM_PIECE_SYMBOLS[piece_type]
+        for square in scan_forward(self.occupied_co[WHITE]):
+            symbols[square] = symbols[square].upper()
+
+        builder = [self._gating_row(BLACK)]
+        for rank in range (7, -1, -1):
+            row = ""
+            empty = 0
+            for symbol in symbols[rank * 8:rank * 8 + 8]:
+                if (symbol is None):
+                    empty += 1
+                    continue
+                if (empty):
+                    row += str(empty)
+                    empty = 0
+                row += symbol
+            builder.append(row + str(empty) if empty else row)
+        builder.append(self._gating_row(WHITE))
+        return "/".join(builder)
+
+    def _gating_row(self, color: Color) -> str:
+        row = ["*"] * 8
+        for slot, symbol in enumerate("SZ"):
+            position = self.gated_positions[color][slot]
+            if (0 <= position < 9):
+                row += ["*"] * (position + 1 - len(row))
+                row[position] = symbol if color == WHITE else symbol.lower()
+        return "".join(row)
+
+    def musketeer_fen(self) -> str:
+        ep_square = self.ep_square if self.ep_square is not None and self.has_legal_en_passant() else None
+        return " ".join([self.musketeer_board_fen(), "w" if self.turn == WHITE else "b", self.castling_xfen(),
+                         SQUARE_NAMES[ep_square] if ep_square is not None else "-",
+                         str(self.halfmove_clock), str(self.fullmove_number)])
+
+    def san_index(self, key: Optional[tuple] = None) -> dict[str, Move]:
+        key = key or self._legal_move_key()
+        index = SAN_INDEX_CACHE.get(key)
+        if (index is None):
+            index = self._san_index()
+            SAN_INDEX_CACHE.put(key, index)
+        return index
+
+    def _san_index(self) -> dict[str, Move]:
+        # The spelling python-chess writes for every legal move, with the disambiguation parse_san needs,
+        # plus the gating suffixes for moves leaving the back rank. Check marks are stripped before lookup.
+        index = {}
+        letters: dict[Square, str] = {}
+        groups: dict[tuple[str, Square, Optional[PieceType]], list[Move]] = {}
+        for move in self.legal_move_list():
+            from_square = move.from_square
+            letter = letters.get(from_square)
+            if (letter is None):
+                custom = self.custom_mailbox[from_square]
+                if (custom is not None):
+                    letter = CUSTOM_PIECE_SYMBOLS[custom].upper()
+                elif (self.pawns & BB_SQUARES[from_square]):
+                    letter = ""
+                else:
+                    letter = PIECE_SYMBOLS[self.piece_type_at(from_square)].upper()
+                letters[from_square] = letter
+            if (letter == "K" and self.is_castling(move)):
+                kingside = square_file(move.to_square) > square_file(from_square)
+                for spelling in (("O-O", "0-0") if kingside else ("O-O-O", "0-0-0")):
+                    index[spelling] = move
+                continue
+            key = (letter, move.to_square, move.promotion)
+            group = groups.get(key)
+            if (group is None):
+                groups[key] = [move]
+            else:
+                group.append(move)
+
+        gates = ["/" + symbol.upper() for symbol, piece_type in CUSTOM_SYMBOL_TYPES.items() if piece_type in self.custom_piece_types]
+        gate_mask = (BB_RANK_1 if self.turn == WHITE else BB_RANK_8) if gates else BB_EMPTY
+        theirs = self.occupied_co[not self.turn]
+        for (letter, to_square, promotion), group in groups.items():
+            to_name = SQUARE_NAMES[to_square]
+            if (BB_SQUARES[to_square] & theirs or (not letter and to_square == self.ep_square)):
+                to_name = "x" + to_name
+            for move in group:
+                # Without a file, parse_san only looks at pawns on the target file
+                if (letter):
+                    san = letter + to_name if len(group) == 1 else letter + self._san_disambiguation(move, group, letter) + to_name
+                elif (len(group) == 1 and move.from_square & 7 == to_square & 7):
+                    san = to_name
+                else:
+                    san = self._san_disambiguation(move, group, letter) + to_name
+                if (promotion):
+                    index[san + PIECE_SYMBOLS[promotion].upper()] = move
+                    san += "=" + PIECE_SYMBOLS[promotion].upper()
+                index[san] = move
+                if (BB_SQUARES[move.from_square] & gate_mask):
+                    for gate in gates:
+                        index[san + gate] = move
+        return index
+
+    def _san_disambiguation(self, move: Move, group: list[Move], letter: str) -> str:
+        from_file = square_file(move.from_square)
+        from_rank = square_rank(move.from_square)
+        if (letter and len(group) == 1):
+            return ""
+        if (not letter and from_file == square_file(move.to_square) and
+                sum(1 for other in group if square_file(other.from_square) == from_file) == 1):
+            return ""
+        if (sum(1 for other in group if square_file(other.from_square) == from_file) == 1):
+            return FILE_NAMES[from_file]
+        if (letter and sum(1 for other in group if square_rank(other.from_square) == from_rank) == 1):
+            return RANK_NAMES[from_rank]
+        return FILE_NAMES[from_file] + RANK_NAMES[from_rank]
 
     def parse_san(self, san: str) -> Move:
+        # Positions seen before (the openings of a game database, transpositions) and custom piece moves
+        # resolve through the SAN index; building it costs a few regex matches, so new positions use the regex
+        key = self._legal_move_key()
+        if (key in SAN_INDEX_CACHE or key in LEGAL_MOVE_CACHE or san[:1].lower() in CUSTOM_SYMBOL_TYPES):
+            move = self.san_index(key).get(san.rstrip("+#"))
+            if (move is not None):
+                return move
+
         # Castling.
         try:
             if (san.find("O-O-O") != -1 or san.find("0-0-0") != -1):
@@ -489,17 +832,183 @@ class CustomBoard(Board):
 
         return matched_move
     
+    def _board_state(self) -> _CustomBoardState:
+        return _CustomBoardState(self)
+
     def push(self, move: Move):
-        super().push(move)
+        moved_type = self.custom_mailbox[move.from_square] if move else None
+        captured_type = self.custom_mailbox[move.to_square] if move else None
+        irreversible = self._is_irreversible_push(move)
+        if (moved_type == None and captured_type == None):
+            super().push(move)
+            self._stack[-1].irreversible = irreversible
+            return
+
+        # The base class mistakes custom pieces for kings, so moves involving them are made here
+        board_state = self._board_state()
+        self.castling_rights = self.clean_castling_rights()
+        self.move_stack.append(move)
+        self._stack.append(board_state)
+
+        self.ep_square = None
+        self.halfmove_clock += 1
+        if self.turn == BLACK:
+            self.fullmove_number += 1
+
+        from_bb = BB_SQUARES[move.from_square]
+        to_bb = BB_SQUARES[move.to_square]
+        if (self.occupied & to_bb or self.pawns & from_bb):
+            self.halfmove_clock = 0
+        self.castling_rights &= ~to_bb & ~from_bb
+
+        if (captured_type != None):
+            self.remove_custom_piece_at(move.to_square)
+        else:
+            self._remove_piece_at(move.to_square)
+
+        if (moved_type != None):
+            self.remove_custom_piece_at(move.from_square)
+            self.set_custom_piece_at(move.to_square, shared_custom_piece(moved_type, self.turn, self.betza_of(moved_type) or ""))
+        else:
+            promoted = bool(self.promoted & from_bb)
+            piece_type = self._remove_piece_at(move.from_square)
+            if (piece_type == KING):
+                self.castling_rights &= ~(BB_RANK_1 if self.turn == WHITE else BB_RANK_8)
+            if move.promotion:
+                promoted = True
+                piece_type = move.promotion
+            self._set_piece_at(move.to_square, piece_type, self.turn, promoted)
+
+        self.turn = not self.turn
+        self._stack[-1].irreversible = irreversible
+
+    def _is_irreversible_push(self, move: Move) -> bool:
+        # Only these moves make every earlier position unreachable; pawn variants can step back
+        if (not move):
+            return False
+        return bool(move.promotion or move.drop or self.occupied_co[not self.turn] & BB_SQUARES[move.to_square]
+                    or self.is_en_passant(move) or self._reduces_castling_rights(move)
+                    or (self.pawns & BB_SQUARES[move.from_square] and self.custom_pawn_type() == 1))
+
+    def _transposition_key(self) -> Hashable:
+        return self.zobrist_hash()
+
+    def is_repetition(self, count: int = 3) -> bool:
+        key = self.zobrist_hash()
+        for state in reversed(self._stack):
+            if (count <= 1):
+                return True
+            if (state.irreversible):
+                break
+            if (state.zobrist_hash == key):
+                count -= 1
+        return count <= 1
+
+    def can_claim_threefold_repetition(self) -> bool:
+        transpositions = collections.Counter((self.zobrist_hash(), ))
+        for state in reversed(self._stack):
+            if (state.irreversible):
+                break
+            transpositions[state.zobrist_hash] += 1
+
+        # Threefold repetition occurred.
+        if (transpositions[self.zobrist_hash()] >= 3):
+            return True
+
+        # The next legal move is a threefold repetition.
+        for move in self.generate_legal_moves():
+            self.push(move)
+            try:
+                if (transpositions[self.zobrist_hash()] >= 2):
+                    return True
+            finally:
+                self.pop()
+        return False
+
+    def copy(self, *, stack: Union[bool, int] = True) -> "CustomBoard":
+        board = super().copy(stack=stack)
+        board.custom_pieces = self.custom_pieces.copy()
+        board.custom_piece_types = self.custom_piece_types.copy()
+        board.gated_positions = [slots.copy() for slots in self.gated_positions]
+        board.custom_mailbox = self.custom_mailbox.copy()
+        board.piece_betza = self.piece_betza.copy()
+        board._zobrist = self._zobrist
+        return board
+
+    def to_bytes(self) -> bytes:
+        # Fixed header, the custom piece types in play, then one nibble per occupied square in square order
+        custom_piece_types = self.custom_piece_types
+        if (len(custom_piece_types) > POSITION_MAX_CUSTOM_TYPES):
+            raise ValueError(f"at most {POSITION_MAX_CUSTOM_TYPES} custom piece types fit in a binary position, got {len(custom_piece_types)}")
+        header = POSITION_HEADER.pack(
+            self.occupied, self.occupied_co[WHITE], self.turn | self.chess960 << 1,
+            (self.castling_rights & BB_RANK_1) & 0xFF, (self.castling_rights & BB_RANK_8) >> 56,
+            0xFF if self.ep_square is None else self.ep_square,
+            min(self.halfmove_clock, 0xFFFF), min(self.fullmove_number, 0xFFFF),
+            *(position for slots in self.gated_positions for position in slots), len(custom_piece_types))
+
+        codes = [0] * 64
+        for piece_type, mask in ((PAWN, self.pawns), (KNIGHT, self.knights), (BISHOP, self.bishops),
+                                 (ROOK, self.rooks), (QUEEN, self.queens), (KING, self.kings)):
+            for square in scan_forward(mask):
+                codes[square] = piece_type
+        for index, mask in enumerate(self.custom_pieces):
+            for square in scan_forward(mask):
+                codes[square] = POSITION_CUSTOM_CODE + index
+        nibbles = [codes[square] for square in scan_forward(self.occupied)]
+        if (len(nibbles) % 2):
+            nibbles.append(0)
+        packed = bytes(nibbles[index] << 4 | nibbles[index + 1] for index in range (0, len(nibbles), 2))
+        return header + bytes(custom_piece_types) + packed
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CustomBoard":
+        (occupied, white, flags, castling_white, castling_black, ep_square, halfmove_clock, fullmove_number,
+         *gates, custom_count) = POSITION_HEADER.unpack_from(data)
+        offset = POSITION_HEADER.size
+        custom_piece_types = list(data[offset:offset + custom_count])
+        offset += custom_count
+
+        board = cls(None, chess960=bool(flags & 2))
+        board.custom_piece_types = custom_piece_types
+        board.custom_pieces = [BB_EMPTY] * custom_count
+        pieces = [BB_EMPTY] * POSITION_CUSTOM_CODE
+        key = 0
+        for index, square in enumerate(scan_forward(occupied)):
+            code = data[offset + index // 2] >> (0 if index % 2 else 4) & 0xF
+            mask = BB_SQUARES[square]
+            color = bool(white & mask)
+            if (code >= POSITION_CUSTOM_CODE):
+                piece_type = custom_piece_types[code - POSITION_CUSTOM_CODE]
+                board.custom_pieces[code - POSITION_CUSTOM_CODE] |= mask
+                board.custom_mailbox[square] = piece_type
+                key ^= zobrist.custom_piece_key(piece_type, color, square)
+            else:
+                pieces[code] |= mask
+                key ^= zobrist.piece_key(code, color, square)
+        board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings = pieces[PAWN:KING + 1]
+        board.occupied = occupied
+        board.occupied_co[WHITE] = white
+        board.occupied_co[BLACK] = occupied & ~white
+
+        board.turn = bool(flags & 1)
+        board.castling_rights = castling_white | castling_black << 56
+        board.ep_square = None if ep_square == 0xFF else ep_square
+        board.halfmove_clock = halfmove_clock
+        board.fullmove_number = fullmove_number
+        board.gated_positions = [list(gates[0:2]), list(gates[2:4])]
+        board._zobrist = key
+        return board
 
     def push_san(self, san: str):
         move = self.parse_san(san)
         self.push(move)
         if (san[-2] == '/'):
-            piece = CustomPiece.from_symbol(san[-1].lower())
-            piece.color = not self.turn
+            piece_type = CUSTOM_PIECE_SYMBOLS.index(san[-1].lower())
+            piece = shared_custom_piece(piece_type, not self.turn, self.betza_of(piece_type) or "")
             self.set_custom_piece_at(move.from_square, piece)
             self.gated_positions[not self.turn][self.custom_piece_types.index(piece.piece_type)] = -1
+            self._stack[-1].irreversible = True
 
         return move
 
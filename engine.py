@@ -0,0 +1,309 @@
+import functools
+import time
+from typing import Optional
+from chess.engine import Cp, InfoDict, Limit, Mate, PlayResult, PovScore, Score
+from board import *
+
+# In-process alpha-beta search for CustomBoard, answering with the same PlayResult/InfoDict
+# shapes as chess.engine so callers can switch between this and an external engine.
+# Gating moves are only made through push_san, so the search does not consider them.
+
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000
+MAX_PLY = 64
+TT_SIZE = 1 << 20
+# Limits are checked every this many nodes
+CHECK_INTERVAL = 1024
+
+[TT_EXACT, TT_LOWER, TT_UPPER] = range(3)
+
+PIECE_VALUES = [0, 100, 320, 330, 500, 900, 0]
+BB_CENTER_SQUARES = BB_CENTER
+BB_EXTENDED_CENTER = BB_CENTER | BB_C3 | BB_D3 | BB_E3 | BB_F3 | BB_C6 | BB_D6 | BB_E6 | BB_F6 | BB_C4 | BB_C5 | BB_F4 | BB_F5
+
+@functools.lru_cache(maxsize=BETZA_CACHE_SIZE)
+def custom_piece_value(betza: str) -> int:
+    # Rough value from the average number of squares the piece reaches on an empty board,
+    # scaled so that a knight (5.25 squares) comes out near 320 and a queen (22.75) near 900
+    compiled = compile_betza(betza)
+    reach = 0
+    for square in SQUARES:
+        attacks = BB_EMPTY
+        for modality in MoveModality.MODALITY_QUIET, MoveModality.MODALITY_CAPTURE:
+            attacks |= compiled.step_attacks[modality][square]
+            attacks |= rider_attacks(compiled.slider_attacks[modality], square, BB_EMPTY)
+            attacks |= crooked_attacks(compiled.crooked_attacks[modality], square, BB_EMPTY)
+            # Hoppers need a screen, count them as reaching every other square of their rays
+            for direction, rays, table in compiled.hopper_attacks[modality]:
+                attacks |= rays[square] & ~BB_SQUARES[square]
+        reach += popcount(attacks)
+    return int(140 + 33 * reach / 64)
+
+class SearchAborted(Exception):
+    """Raised inside the search when the node or time limit is exceeded."""
+
+class Searcher:
+    def __init__(self, tt_size: int = TT_SIZE):
+        self.tt_size = tt_size
+        self.tt: dict[int, tuple[int, int, int, Optional[Move]]] = {}
+        self.nodes = 0
+        self.seldepth = 0
+
+    def clear(self) -> None:
+        self.tt.clear()
+
+    def piece_value_at(self, board: CustomBoard, square: Square) -> int:
+        custom = board.custom_mailbox[square]
+        if (custom is not None):
+            return custom_piece_value(board.betza_of(custom) or "")
+        piece_type = board.piece_type_at(square)
+        return PIECE_VALUES[piece_type] if piece_type else 0
+
+    def evaluate(self, board: CustomBoard) -> int:
+        # Material and a small bonus for central pieces, from the side to move's point of view
+        white = board.occupied_co[WHITE]
+        black = board.occupied_co[BLACK]
+        score = 0
+        for piece_type, mask in ((PAWN, board.pawns), (KNIGHT, board.knights), (BISHOP, board.bishops),
+                                 (ROOK, board.rooks), (QUEEN, board.queens)):
+            score += PIECE_VALUES[piece_type] * (popcount(mask & white) - popcount(mask & black))
+        for piece_type, mask in zip(board.custom_piece_types, board.custom_pieces):
+            if (mask & ~board.pawns):
+                value = custom_piece_value(board.betza_of(piece_type) or "")
+                score += value * (popcount(mask & white & ~board.pawns) - popcount(mask & black & ~board.pawns))
+
+        pieces = board.occupied & ~board.pawns & ~board.kings
+        score += 10 * (popcount(pieces & white & BB_EXTENDED_CENTER) - popcount(pieces & black & BB_EXTENDED_CENTER))
+        score += 10 * (popcount(board.pawns & white & BB_CENTER_SQUARES) - popcount(board.pawns & black & BB_CENTER_SQUARES))
+        return score if board.turn == WHITE else -score
+
+    def is_losing_capture(self, board: CustomBoard, move: Move, defended: Bitboard) -> bool:
+        # A cheaper piece on a defended square is not worth the attacker, short of a full exchange evaluation
+        return bool(defended & BB_SQUARES[move.to_square]) and (
+            self.piece_value_at(board, move.to_square) < self.piece_value_at(board, move.from_square))
+
+    def order_moves(self, board: CustomBoard, moves: list[Move], tt_move: Optional[Move], ply: int,
+                    defended: Optional[Bitboard] = None) -> list[Move]:
+        killers = self.killers[ply]
+        if (defended is None):
+            # All squares the opponent attacks, from the set-wise attacks of every piece type at once
+            defended = board.side_attacks_mask(not board.turn)
+        def key(move: Move) -> int:
+            if (move == tt_move):
+                return 1 << 30
+            if (board.occupied_co[not board.turn] & BB_SQUARES[move.to_square]):
+                if (self.is_losing_capture(board, move, defended)):
+                    # After the killers, but ahead of quiet moves without history
+                    return (1 << 18) + self.piece_value_at(board, move.to_square)
+                # Most valuable victim, least valuable attacker
+                return (1 << 20) + 16 * self.piece_value_at(board, move.to_square) - self.piece_value_at(board, move.from_square) // 16
+            if (move.promotion):
+                return (1 << 20) + PIECE_VALUES[move.promotion]
+            if (move in killers):
+                return 1 << 19
+            return self.history.get((board.turn, move.from_square, move.to_square), 0)
+        return sorted(moves, key=key, reverse=True)
+
+    def check_limits(self) -> None:
+        if (self.max_nodes is not None and self.nodes >= self.max_nodes):
+            raise SearchAborted()
+        if (self.deadline is not None and time.perf_counter() >= self.deadline):
+            raise SearchAborted()
+
+    def quiescence(self, board: CustomBoard, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if (self.nodes % CHECK_INTERVAL == 0):
+            self.check_limits()
+        self.seldepth = max(self.seldepth, ply)
+
+        stand_pat = self.evaluate(board)
+        if (stand_pat >= beta or ply >= MAX_PLY):
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        captures = list(board.generate_pseudo_legal_moves(BB_ALL, board.occupied_co[not board.turn]))
+        if (not captures):
+            return alpha
+        # Losing captures are left out, they would rarely raise alpha and make most of the tree
+        defended = board.side_attacks_mask(not board.turn)
+        captures = [move for move in captures if (not self.is_losing_capture(board, move, defended))]
+        for move in self.order_moves(board, captures, None, ply, defended):
+            board.push(move)
+            if (board.was_into_check()):
+                board.pop()
+                continue
+            score = -self.quiescence(board, -beta, -alpha, ply + 1)
+            board.pop()
+            if (score >= beta):
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def search(self, board: CustomBoard, depth: int, alpha: int, beta: int, ply: int) -> int:
+        if (depth <= 0):
+            return self.quiescence(board, alpha, beta, ply)
+        self.nodes += 1
+        if (self.nodes % CHECK_INTERVAL == 0):
+            self.check_limits()
+        self.seldepth = max(self.seldepth, ply)
+
+        if (ply > 0 and (board.halfmove_clock >= 100 or board.is_repetition(2))):
+            return 0
+
+        key = board.zobrist_hash()
+        entry = self.tt.get(key)
+        tt_move = None
+        if (entry is not None):
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if (ply > 0 and tt_depth >= depth):
+                tt_score = self.score_from_tt(tt_score, ply)
+                if (tt_flag == TT_EXACT or (tt_flag == TT_LOWER and tt_score >= beta)
+                        or (tt_flag == TT_UPPER and tt_score <= alpha)):
+                    return tt_score
+
+        # Legality is only tested for the moves that get searched, after they are made
+        moves = list(board.generate_pseudo_legal_moves())
+        original_alpha = alpha
+        best_score = -MATE_SCORE
+        best_move = None
+        legal_moves = 0
+        for move in self.order_moves(board, moves, tt_move, ply):
+            board.push(move)
+            if (board.was_into_check()):
+                board.pop()
+                continue
+            legal_moves += 1
+            if (legal_moves == 1):
+                score = -self.search(board, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # Principal variation search: prove the move is worse with a null window first
+                score = -self.search(board, depth - 1, -alpha - 1, -alpha, ply + 1)
+                if (alpha < score < beta):
+                    score = -self.search(board, depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+
+            if (score > best_score):
+                best_score = score
+                best_move = move
+            if (score > alpha):
+                alpha = score
+            if (alpha >= beta):
+                if (not board.occupied_co[not board.turn] & BB_SQUARES[move.to_square]):
+                    killers = self.killers[ply]
+                    if (move not in killers):
+                        killers.insert(0, move)
+                        del killers[2:]
+                    history_key = (board.turn, move.from_square, move.to_square)
+                    self.history[history_key] = self.history.get(history_key, 0) + depth * depth
+                break
+
+        if (not legal_moves):
+            return -(MATE_SCORE - ply) if board.is_check() else 0
+        if (best_score <= original_alpha):
+            flag = TT_UPPER
+        elif (best_score >= beta):
+            flag = TT_LOWER
+        else:
+            flag = TT_EXACT
+        if (len(self.tt) >= self.tt_size):
+            self.tt.clear()
+        self.tt[key] = (depth, self.score_to_tt(best_score, ply), flag, best_move)
+        return best_score
+
+    def score_to_tt(self, score: int, ply: int) -> int:
+        # Mate scores are stored relative to the node, not the root
+        if (score >= MATE_BOUND):
+            return score + ply
+        if (score <= -MATE_BOUND):
+            return score - ply
+        return score
+
+    def score_from_tt(self, score: int, ply: int) -> int:
+        if (score >= MATE_BOUND):
+            return score - ply
+        if (score <= -MATE_BOUND):
+            return score + ply
+        return score
+
+    def principal_variation(self, board: CustomBoard, depth: int) -> list[Move]:
+        pv = []
+        board = board.copy()
+        seen = set()
+        while (len(pv) < depth):
+            key = board.zobrist_hash()
+            entry = self.tt.get(key)
+            if (entry is None or entry[3] is None or key in seen or entry[3] not in board._generate_legal_moves()):
+                break
+            seen.add(key)
+            pv.append(entry[3])
+            board.push(entry[3])
+        return pv
+
+    def pov_score(self, board: CustomBoard, score: int) -> PovScore:
+        if (score >= MATE_BOUND):
+            return PovScore(Mate((MATE_SCORE - score + 1) // 2), board.turn)
+        if (score <= -MATE_BOUND):
+            return PovScore(Mate(-((MATE_SCORE + score) // 2)), board.turn)
+        return PovScore(Cp(score), board.turn)
+
+    def score_value(self, score: Score) -> int:
+        # Inverse of pov_score for a score from the side to move's point of view
+        if (score.is_mate()):
+            mate = score.mate()
+            return MATE_SCORE - (2 * mate - 1) if mate > 0 else -(MATE_SCORE + 2 * mate)
+        return score.score()
+
+    def analyse(self, board: CustomBoard, limit: Limit, *,
+                window: tuple[int, int] = (-MATE_SCORE, MATE_SCORE)) -> InfoDict:
+        # Iterative deepening; the result of the last completed depth is reported.
+        # A narrower window only applies to the last depth, whose score may then be a bound
+        start = time.perf_counter()
+        self.deadline = start + limit.time if limit.time is not None else None
+        self.max_nodes = limit.nodes
+        self.nodes = 0
+        self.seldepth = 0
+        self.killers = [[] for ply in range (MAX_PLY + 1)]
+        self.history = {}
+        max_depth = limit.depth if limit.depth is not None else MAX_PLY
+
+        board = board.copy()
+        info: InfoDict = {}
+        depth = 1
+        while (depth <= max_depth):
+            try:
+                alpha, beta = window if (depth == max_depth) else (-MATE_SCORE, MATE_SCORE)
+                score = self.search(board, depth, alpha, beta, 0)
+            except SearchAborted:
+                # The first iteration always completes, so there is a move to play
+                if (info):
+                    break
+                self.max_nodes = self.deadline = None
+                continue
+            elapsed = time.perf_counter() - start
+            info = {
+                "depth": depth,
+                "seldepth": self.seldepth,
+                "score": self.pov_score(board, score),
+                "nodes": self.nodes,
+                "nps": int(self.nodes / elapsed) if elapsed > 0 else 0,
+                "time": elapsed,
+                "pv": self.principal_variation(board, depth),
+            }
+            if (abs(score) >= MATE_BOUND):
+                break
+            depth += 1
+        return info
+
+    def play(self, board: CustomBoard, limit: Limit) -> PlayResult:
+        info = self.analyse(board, limit)
+        pv = info.get("pv", [])
+        if (not pv):
+            # A mated or stalemated side has nothing to play, like a resigning engine
+            return PlayResult(None, None, info)
+        return PlayResult(pv[0], pv[1] if len(pv) > 1 else None, info)
+
+def play(board: CustomBoard, limit: Limit) -> PlayResult:
+    return Searcher().play(board, limit)
+
+def analyse(board: CustomBoard, limit: Limit) -> InfoDict:
+    return Searcher().analyse(board, limit)
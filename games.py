@@ -0,0 +1,154 @@
+import collections
+import secrets
+import threading
+import time
+from typing import Callable, Optional
+from board import *
+
+# In-memory games for the web app, keyed by a random game id that the client keeps in its session.
+# Games are spread over shards that each have their own lock, and every game has a lock for its board,
+# so requests for different games never wait on one shared object.
+
+GAME_STORE_MAX_GAMES = 1024
+GAME_STORE_TTL = 3600.0
+GAME_STORE_MAX_BYTES = 64 << 20
+GAME_STORE_SHARDS = 16
+# Rough memory footprint of a game: the board with its caches, plus every move and saved state on the stack
+GAME_BASE_BYTES = 8192
+GAME_MOVE_BYTES = 1024
+
+def new_game_id() -> str:
+    return secrets.token_urlsafe(16)
+
+class Game:
+    def __init__(self, game_id: str, board: CustomBoard):
+        self.game_id = game_id
+        self.board = board
+        # Number of saves, which a database uses to spot stale copies
+        self.version = 0
+        # Held while a request reads or changes the board
+        self.lock = threading.Lock()
+        self.last_access = time.monotonic()
+        self.size = self.estimate_size()
+
+    def estimate_size(self) -> int:
+        return GAME_BASE_BYTES + GAME_MOVE_BYTES * len(self.board.move_stack)
+
+class _Shard:
+    def __init__(self):
+        # Least recently used game first
+        self.games: collections.OrderedDict[str, Game] = collections.OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+class GameStore:
+    # LRU store of games with a time to live and a memory cap, both enforced per shard
+    def __init__(self, max_games: int = GAME_STORE_MAX_GAMES, ttl: Optional[float] = GAME_STORE_TTL,
+                 max_bytes: int = GAME_STORE_MAX_BYTES, shards: int = GAME_STORE_SHARDS,
+                 board_factory: Callable[[], CustomBoard] = CustomBoard):
+        self.max_games = max_games
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.board_factory = board_factory
+        self._shards = [_Shard() for shard in range (max(1, shards))]
+        self._shard_games = max(1, max_games // len(self._shards))
+        self._shard_bytes = max(1, max_bytes // len(self._shards))
+
+    def _shard(self, game_id: str) -> _Shard:
+        return self._shards[hash(game_id) % len(self._shards)]
+
+    def _expired(self, game: Game, now: float) -> bool:
+        return self.ttl is not None and now - game.last_access > self.ttl
+
+    def _remove(self, shard: _Shard, game_id: str) -> Optional[Game]:
+        game = shard.games.pop(game_id, None)
+        if (game is not None):
+            shard.size -= game.size
+        return game
+
+    def _trim(self, shard: _Shard, now: float) -> None:
+        # The least recently used game is first, so expired games are always at the front
+        while (shard.games):
+            game_id, game = next(iter(shard.games.items()))
+            if (self._expired(game, now)):
+                shard.expirations += 1
+            elif (len(shard.games) > self._shard_games or shard.size > self._shard_bytes):
+                shard.evictions += 1
+            else:
+                break
+            self._remove(shard, game_id)
+
+    def get(self, game_id: str) -> Optional[Game]:
+        shard = self._shard(game_id)
+        now = time.monotonic()
+        with shard.lock:
+            game = shard.games.get(game_id)
+            if (game is None):
+                return None
+            if (self._expired(game, now)):
+                shard.expirations += 1
+                self._remove(shard, game_id)
+                return None
+            game.last_access = now
+            shard.games.move_to_end(game_id)
+            return game
+
+    def add(self, game: Game) -> Game:
+        shard = self._shard(game.game_id)
+        now = time.monotonic()
+        with shard.lock:
+            self._remove(shard, game.game_id)
+            game.last_access = now
+            game.size = game.estimate_size()
+            shard.games[game.game_id] = game
+            shard.size += game.size
+            self._trim(shard, now)
+        return game
+
+    def create(self, board: Optional[CustomBoard] = None) -> Game:
+        return self.add(Game(new_game_id(), board if board is not None else self.board_factory()))
+
+    def update(self, game: Game) -> bool:
+        # Call after changing a game's board, so that its size counts against the memory cap.
+        # Returns False if the game was evicted in the meantime and the change is lost
+        shard = self._shard(game.game_id)
+        with shard.lock:
+            if (shard.games.get(game.game_id) is not game):
+                return False
+            size = game.estimate_size()
+            shard.size += size - game.size
+            game.size = size
+            self._trim(shard, time.monotonic())
+            return True
+
+    def discard(self, game_id: str) -> None:
+        shard = self._shard(game_id)
+        with shard.lock:
+            self._remove(shard, game_id)
+
+    def purge(self) -> int:
+        # Drop every expired game, returns how many were dropped
+        purged = 0
+        now = time.monotonic()
+        for shard in self._shards:
+            with shard.lock:
+                expirations = shard.expirations
+                self._trim(shard, now)
+                purged += shard.expirations - expirations
+        return purged
+
+    def __len__(self) -> int:
+        return sum(len(shard.games) for shard in self._shards)
+
+    def __contains__(self, game_id: str) -> bool:
+        shard = self._shard(game_id)
+        with shard.lock:
+            return game_id in shard.games
+
+    def info(self) -> dict[str, int]:
+        return {"games": len(self), "bytes": sum(shard.size for shard in self._shards),
+                "max_games": self.max_games, "max_bytes": self.max_bytes,
+                "evictions": sum(shard.evictions for shard in self._shards),
+                "expirations": sum(shard.expirations for shard in self._shards)}
@@ -1,41 +1,221 @@
-from flask import Flask, request, render_template, jsonify
+import functools
+import hashlib
+import json
+import os
+import secrets
+import threading
+from flask import Flask, request, render_template, jsonify, session
 from board import *
+from engine import Limit, Searcher
+from games import GAME_STORE_MAX_BYTES, GAME_STORE_MAX_GAMES, GAME_STORE_TTL, Game, GameStore
+from storage import GameDatabase
+from tokens import InvalidTokenError, board_from_token, position_token
 
 app = Flask(__name__)
+# Every worker must sign the session cookies with the same key, or games are lost between them
+app.secret_key = os.environ.get("SECRET_KEY") or secrets.token_hex(32)
+# Position tokens are signed with their own key, derived from the same secret
+TOKEN_KEY = hashlib.sha256(b"position-token:" + app.secret_key.encode()).digest()
+# Stateless API answers depend on nothing but the URL
+API_CACHE_MAX_AGE = 365 * 24 * 3600
+# Betza previews are revalidated daily through their ETag, in case the Betza parser changes
+BETZA_PREVIEW_MAX_AGE = 24 * 3600
+BETZA_PREVIEW_CACHE_SIZE = 4096
+MAX_BETZA_LENGTH = 64
 
-chess_board = CustomBoard()
-chess_board.clear_board()
-LAST_CLICKED_SQUARE = None
+
+def empty_board() -> CustomBoard:
+    board = CustomBoard()
+    board.clear_board()
+    return board
+
+
+games = GameStore(max_games=int(os.environ.get("GAME_STORE_MAX_GAMES", GAME_STORE_MAX_GAMES)),
+                  ttl=float(os.environ.get("GAME_STORE_TTL", GAME_STORE_TTL)),
+                  max_bytes=int(os.environ.get("GAME_STORE_MAX_BYTES", GAME_STORE_MAX_BYTES)),
+                  board_factory=empty_board)
+# With a database every worker process sees every game, and the in-memory store becomes its cache
+if (os.environ.get("GAME_DATABASE")):
+    games = GameDatabase(os.environ["GAME_DATABASE"], cache=games)
+# Searchers keep per-search state, so each serving thread gets its own
+searchers = threading.local()
 starting_square: Square = -1
 
 
+def current_game() -> Game:
+    # The game of this session, or a new one if it never had one or it was evicted
+    game_id = session.get("game_id")
+    game = games.get(game_id) if game_id else None
+    if (game is None):
+        game = games.create()
+        session["game_id"] = game.game_id
+    return game
+
+
+def searcher() -> Searcher:
+    if (not hasattr(searchers, "searcher")):
+        searchers.searcher = Searcher()
+    return searchers.searcher
+
+
 def invert_index(index):
     return (7 - index // 8) * 8 + index % 8
 
 
+def find_legal_move(board: CustomBoard, from_square: Square, to_square: Square) -> Optional[Move]:
+    # Like Board.find_move, pawns reaching the back rank become queens unless told otherwise
+    for move in board.generate_legal_moves(BB_SQUARES[from_square], BB_SQUARES[to_square]):
+        if (move.promotion in (None, QUEEN)):
+            return move
+    return None
+
+
 @app.route('/')
 def home():
-    return render_template('index.html', board=chess_board)
+    game = current_game()
+    with game.lock:
+        return render_template('index.html', board=game.board)
+
+
+@app.route('/new_game', methods=['POST'])
+def new_game():
+    games.discard(session.get("game_id", ""))
+    game = games.create()
+    session["game_id"] = game.game_id
+    return jsonify(game.board.musketeer_fen())
 
 
 @app.route('/legal_moves/<int:index>')
 def legal_moves(index):
-    global LAST_CLICKED_SQUARE
-
-    LAST_CLICKED_SQUARE = (index := invert_index(index))
-    moves = [
-        move.to_square for move in chess_board.legal_moves
-        if move.from_square == index
-    ]
+    game = current_game()
+    with game.lock:
+        # The selection lives in the session, so the next request may go to any worker
+        session["selected_square"] = (index := invert_index(index))
+        moves = [
+            move.to_square for move in game.board.generate_legal_moves(BB_SQUARES[index])
+        ]
 
     return jsonify(moves)
 
 
+@app.route('/cache_info')
+def cache_info():
+    return jsonify(LEGAL_MOVE_CACHE.info())
+
+
+@app.route('/game_store_info')
+def game_store_info():
+    return jsonify(games.info())
+
+
+@app.route('/move_map')
+def move_map():
+    # All legal moves of the position at once, so the page needs one request per turn instead of one per click
+    game = current_game()
+    with game.lock:
+        return jsonify({"fen": game.board.musketeer_fen(), "moves": game.board.legal_move_map()})
+
+
 @app.route('/make_move/<int:index>', methods=['POST'])
-def make_move(index):
-    # noinspection PyTypeChecker
-    chess_board.push(Move(LAST_CLICKED_SQUARE, invert_index(index)))
-    return jsonify(chess_board.fen())
+@app.route('/make_move/<int:from_index>/<int:index>', methods=['POST'])
+def make_move(index, from_index=None):
+    game = current_game()
+    with game.lock:
+        # Pages using /move_map send the origin along, the others selected it through /legal_moves
+        from_square = invert_index(from_index) if from_index is not None else session.get("selected_square")
+        if (from_square is None):
+            return jsonify({"error": "no square selected"}), 400
+        move = find_legal_move(game.board, from_square, invert_index(index))
+        if (move is None):
+            return jsonify({"error": f"illegal move: {SQUARE_NAMES[from_square]}{SQUARE_NAMES[invert_index(index)]}"}), 400
+        game.board.push(move)
+        fen = game.board.musketeer_fen()
+        if (not games.update(game)):
+            return jsonify({"error": "game changed, reload it"}), 409
+    return jsonify(fen)
+
+
+@app.route('/engine_move/<int:depth>', methods=['POST'])
+def engine_move(depth):
+    game = current_game()
+    with game.lock:
+        # The time limit keeps the page responsive when a variant makes the search slow
+        result = searcher().play(game.board, Limit(depth=depth, time=1.0))
+        if (result.move is not None):
+            game.board.push(result.move)
+            if (not games.update(game)):
+                return jsonify({"error": "game changed, reload it"}), 409
+        fen = game.board.musketeer_fen()
+    return jsonify({"move": result.move.uci() if result.move else None, "fen": fen,
+                    "depth": result.info.get("depth"), "nodes": result.info.get("nodes"), "nps": result.info.get("nps")})
+
+
+# Stateless API: the client sends the signed position token with every call and gets a new one back,
+# so any worker behind a load balancer can answer without sessions or a database
+
+
+def token_board() -> CustomBoard:
+    return board_from_token(request.values.get("position", ""), TOKEN_KEY)
+
+
+def token_response(board: CustomBoard, **fields):
+    return jsonify({"position": position_token(board, TOKEN_KEY), "fen": board.musketeer_fen(), **fields})
+
+
+@app.errorhandler(InvalidTokenError)
+def invalid_token(error):
+    return jsonify({"error": str(error)}), 400
+
+
+@app.route('/api/position', methods=['GET', 'POST'])
+def api_position():
+    # Optional Musketeer FEN, and a JSON object of custom piece types to their Betza strings (null for pawn types)
+    board = empty_board()
+    try:
+        for piece_type, betza in json.loads(request.values.get("pieces", "{}")).items():
+            if (int(piece_type) not in CUSTOM_PIECE_TYPES or not (betza is None or (
+                    isinstance(betza, str) and betza.isascii() and len(betza) <= MAX_BETZA_LENGTH))):
+                raise ValueError(f"invalid custom piece: {piece_type!r}: {betza!r}")
+            board.add_custom_piece_type(int(piece_type), betza)
+        fen = request.values.get("fen")
+        if (fen):
+            board.set_musketeer_fen(fen)
+        # Encoding fails too, e.g. with more custom types than a binary position can hold
+        return token_response(board)
+    except (ValueError, AttributeError) as error:
+        return jsonify({"error": str(error)}), 400
+
+
+@app.route('/api/legal_moves/<int:index>')
+def api_legal_moves(index):
+    board = token_board()
+    index = invert_index(index)
+    response = jsonify([move.to_square for move in board.generate_legal_moves(BB_SQUARES[index])])
+    response.cache_control.public = True
+    response.cache_control.max_age = API_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/api/move_map')
+def api_move_map():
+    board = token_board()
+    response = jsonify({"fen": board.musketeer_fen(), "moves": board.legal_move_map()})
+    response.cache_control.public = True
+    response.cache_control.max_age = API_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/api/make_move/<int:from_index>/<int:to_index>', methods=['POST'])
+def api_make_move(from_index, to_index):
+    board = token_board()
+    from_square, to_square = invert_index(from_index), invert_index(to_index)
+    move = find_legal_move(board, from_square, to_square)
+    if (move is None):
+        return jsonify({"error": f"illegal move: {SQUARE_NAMES[from_square]}{SQUARE_NAMES[to_square]}"}), 400
+    board.push(move)
+    return token_response(board, move=move.uci())
 
 
 # @app.route('/', methods = ['POST'])
@@ -44,14 +224,31 @@ def make_move(index):
 #     starting_square = invert_index(index)
 
 
+@functools.lru_cache(maxsize=BETZA_PREVIEW_CACHE_SIZE)
+def betza_preview(betza: str, square: Square, occupied: Bitboard, theirs: Bitboard) -> tuple[Square, ...]:
+    # Both this cache and compile_betza are bounded, so previews of arbitrary strings cannot grow memory
+    return tuple(scan_reversed(compile_betza(betza).moves_mask(square, occupied) & (~occupied | theirs)))
+
+
 @app.route('/get_betza/<string:betza>')
 def get_betza(betza):
-    chess_board.custom_pieces.append(BB_EMPTY)
-    chess_board.custom_piece_types.append(CUSTOM_PIECE_TYPES[STORM])
-    CUSTOM_BETZA[CUSTOM_PIECE_TYPES[STORM]] = betza
-    new_piece = CustomPiece(CUSTOM_PIECE_TYPES[STORM], WHITE, betza)
-    chess_board.set_custom_piece_at(E4, new_piece)
-    return jsonify([move.to_square for move in chess_board.generate_pseudo_legal_moves(BB_E4, BB_ALL)])
+    # Squares a piece with this Betza string reaches from a square (e4 by default) on an empty board,
+    # or on the board of an optional position token, capturing the pieces of the side not to move
+    square_name = request.args.get("square", "e4")
+    if (len(betza) > MAX_BETZA_LENGTH or square_name not in SQUARE_NAMES):
+        return jsonify({"error": f"invalid preview: {betza!r} from {square_name!r}"}), 400
+    square = SQUARE_NAMES.index(square_name)
+    occupied = theirs = BB_EMPTY
+    if (request.args.get("position")):
+        board = token_board()
+        occupied = board.occupied & ~BB_SQUARES[square]
+        theirs = board.occupied_co[not board.turn]
+
+    response = jsonify(betza_preview(betza, square, occupied, theirs))
+    response.set_etag(hashlib.sha256(f"{betza}:{square}:{occupied}:{theirs}".encode()).hexdigest()[:32])
+    response.cache_control.public = True
+    response.cache_control.max_age = BETZA_PREVIEW_MAX_AGE
+    return response.make_conditional(request)
 
 
 # @app.route('/', methods = ['GET'])
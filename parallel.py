@@ -0,0 +1,115 @@
+import concurrent.futures
+import time
+from typing import Optional
+from chess.engine import InfoDict, Limit, Mate, MateGiven, PlayResult, PovScore
+from board import *
+import engine
+import perft
+
+# Root-split drivers: every root move of a position is handed to a worker process.
+# Workers get the position from CustomBoard.to_bytes() plus the board's Betza definitions,
+# about fifty bytes instead of a pickled board with its move stack.
+
+def _perft_worker(definitions, position: bytes, uci: str, depth: int) -> tuple[str, int]:
+    board = CustomBoard.from_bytes(position)
+    board.set_piece_definitions(definitions)
+    board.push(Move.from_uci(uci))
+    return uci, perft.perft(board, depth - 1)
+
+def _search_worker(definitions, position: bytes, uci: str, limit: Limit,
+                   window: tuple[int, int]) -> tuple[str, int, InfoDict]:
+    # The score comes back as an int from the child's point of view, to compare against the window
+    board = CustomBoard.from_bytes(position)
+    board.set_piece_definitions(definitions)
+    board.push(Move.from_uci(uci))
+    searcher = engine.Searcher()
+    info = searcher.analyse(board, limit, window=window)
+    return uci, searcher.score_value(info["score"].relative), info
+
+def _map_root_moves(board: CustomBoard, worker, argument, executor: Optional[concurrent.futures.Executor], jobs: Optional[int]) -> list:
+    definitions = board.piece_definitions()
+    position = board.to_bytes()
+    moves = [move.uci() for move in board._generate_legal_moves()]
+    if (executor is not None):
+        futures = [executor.submit(worker, definitions, position, uci, argument) for uci in moves]
+        return [future.result() for future in futures]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(worker, definitions, position, uci, argument) for uci in moves]
+        return [future.result() for future in futures]
+
+def parallel_divide(board: CustomBoard, depth: int, *, executor: Optional[concurrent.futures.Executor] = None,
+                    jobs: Optional[int] = None) -> dict[str, int]:
+    if (depth <= 1):
+        return perft.divide(board, depth)
+    return dict(_map_root_moves(board, _perft_worker, depth, executor, jobs))
+
+def parallel_perft(board: CustomBoard, depth: int, *, executor: Optional[concurrent.futures.Executor] = None,
+                   jobs: Optional[int] = None) -> int:
+    if (depth <= 1):
+        return perft.perft(board, depth)
+    return sum(parallel_divide(board, depth, executor=executor, jobs=jobs).values())
+
+def _search_moves(executor: concurrent.futures.Executor, board: CustomBoard, moves: list[str], limit: Limit,
+                  window: tuple[int, int]) -> list[tuple[str, int, InfoDict]]:
+    definitions = board.piece_definitions()
+    position = board.to_bytes()
+    futures = [executor.submit(_search_worker, definitions, position, uci, limit, window) for uci in moves]
+    return [future.result() for future in futures]
+
+def _play_root_moves(executor: concurrent.futures.Executor, board: CustomBoard, limit: Limit,
+                     child_limit: Limit) -> list[tuple[str, int, InfoDict]]:
+    # The move a shallow search likes best is searched first with a full window. Every other move
+    # only has to show that it beats that score, which a null window around it proves cheaply;
+    # the few that do are searched again with the window of the best score so far.
+    moves = [move.uci() for move in board._generate_legal_moves()]
+    shallow = engine.Searcher().analyse(board, Limit(depth=max(1, limit.depth - 2)))
+    if (shallow.get("pv")):
+        first = shallow["pv"][0].uci()
+        moves.remove(first)
+        moves.insert(0, first)
+    results = _search_moves(executor, board, moves[:1], child_limit, (-engine.MATE_SCORE, engine.MATE_SCORE))
+    # Child scores are from the opponent's point of view: the lowest one is the best root move
+    best = results[0][1]
+    better = []
+    for result in _search_moves(executor, board, moves[1:], child_limit, (best - 1, best)):
+        (better if result[1] < best else results).append(result)
+    if (better):
+        results += _search_moves(executor, board, [uci for uci, score, info in better], child_limit,
+                                 (-engine.MATE_SCORE, best))
+    return results
+
+def parallel_play(board: CustomBoard, limit: Limit, *, executor: Optional[concurrent.futures.Executor] = None,
+                  jobs: Optional[int] = None) -> PlayResult:
+    # Root moves are searched one ply shallower in the workers, sharing the best score found first
+    # as their window; the time and node limits apply per worker
+    if (limit.depth is None or limit.depth <= 1):
+        return engine.Searcher().play(board, limit)
+    if (not any(board._generate_legal_moves())):
+        return engine.Searcher().play(board, limit)
+    start = time.perf_counter()
+    child_limit = Limit(depth=limit.depth - 1, time=limit.time, nodes=limit.nodes)
+    if (executor is not None):
+        results = _play_root_moves(executor, board, limit, child_limit)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = _play_root_moves(pool, board, limit, child_limit)
+
+    best_uci, best_value, best_info = min(results, key=lambda result: result[1])
+    # A mate we give takes our root move as well
+    score = best_info["score"].pov(board.turn)
+    if (score.is_mate() and (score is MateGiven or score.mate() > 0)):
+        score = Mate(score.mate() + 1)
+    elapsed = time.perf_counter() - start
+    nodes = sum(info.get("nodes", 0) for uci, value, info in results)
+    best_move = Move.from_uci(best_uci)
+    pv = [best_move] + best_info.get("pv", [])
+    info: InfoDict = {
+        "depth": limit.depth,
+        "seldepth": max(info.get("seldepth", 0) for uci, value, info in results) + 1,
+        "score": PovScore(score, board.turn),
+        "nodes": nodes,
+        "nps": int(nodes / elapsed) if elapsed > 0 else 0,
+        "time": elapsed,
+        "pv": pv,
+    }
+    return PlayResult(best_move, pv[1] if len(pv) > 1 else None, info)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import subprocess
+import time
+from board import *
+
+# Perft positions for CustomBoard: (name, Musketeer FEN, custom piece types with their Betza)
+# Gating rows are only parsed for S and Z, so '*' marks an empty gating square.
+# Only the types with a letter (z, s, h, v) can stand on the board, so "riders" and "hoppers" borrow
+# the STORM and HORIZONTAL_ZIGZAG slots for pieces of their own: the Betza given here decides how they
+# move, not the piece the slot is named after. Results record these definitions and --compare refuses
+# a baseline made with other ones, so a change to a slot cannot pass for a change in node counts.
+START = "********/rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR/********"
+PAWN_TYPES = [("sergeant", SERGEANT), ("captain", CAPTAIN), ("colonel", COLONEL), ("commander", COMMANDER),
+              ("corporal", CORPORAL), ("general", GENERAL), ("lieutenant", LIEUTENANT)]
+
+POSITIONS = [("standard", START, {})]
+POSITIONS += [(name, START, {CUSTOM_PIECE_TYPES[pawn_type]: None}) for name, pawn_type in PAWN_TYPES]
+POSITIONS += [
+    ("zigzag", "********/rnbqkbnr/pppppppp/4z3/8/8/3Z4/PPPPPPPP/RNBQKBNR/********", {CUSTOM_PIECE_TYPES[ZIGZAG]: "zF7"}),
+    ("horizontal-zigzag", "********/rnbqkbnr/pppppppp/4h3/8/8/3H4/PPPPPPPP/RNBQKBNR/********", {CUSTOM_PIECE_TYPES[HORIZONTAL_ZIGZAG]: "zW7"}),
+    ("vertical-zigzag", "********/rnbqkbnr/pppppppp/6v1/8/8/1V6/PPPPPPPP/RNBQKBNR/********", {CUSTOM_PIECE_TYPES[VERTICAL_ZIGZAG]: "zN3"}),
+    ("riders", "********/rnbqkbnr/pppppppp/2h2s2/8/8/2S2H2/PPPPPPPP/RNBQKBNR/********",
+     {CUSTOM_PIECE_TYPES[STORM]: "N2", CUSTOM_PIECE_TYPES[HORIZONTAL_ZIGZAG]: "fBfsWbB2bR"}),
+    ("hoppers", "********/rnbqkbnr/pppppppp/5s2/8/8/2S5/PPPPPPPP/RNBQKBNR/********", {CUSTOM_PIECE_TYPES[STORM]: "mRcpR"}),
+]
+
+# Node counts at depths 1 to 3, which test_perft.py checks
+PERFT_EXPECTED = {
+    "standard": [20, 400, 8902],
+    "sergeant": [20, 400, 8902],
+    "captain": [34, 1156, 39546],
+    "colonel": [34, 1156, 40980],
+    "commander": [34, 1156, 40952],
+    "corporal": [20, 400, 9142],
+    "general": [34, 1156, 40934],
+    "lieutenant": [20, 400, 9862],
+    "zigzag": [29, 790, 22907],
+    "horizontal-zigzag": [38, 1387, 48951],
+    "vertical-zigzag": [27, 697, 19095],
+    "riders": [29, 855, 26326],
+    "hoppers": [28, 721, 19901],
+}
+
+def setup_board(musketeer_fen: str, piece_types: dict) -> CustomBoard:
+    board = CustomBoard()
+    for piece_type, betza in piece_types.items():
+        board.add_custom_piece_type(piece_type, betza)
+    board.set_musketeer_board_fen(musketeer_fen)
+    return board
+
+# Perft measures move generation itself, so it bypasses LEGAL_MOVE_CACHE
+def perft(board: CustomBoard, depth: int) -> int:
+    if (depth <= 1):
+        return sum(1 for move in board._generate_legal_moves()) if depth == 1 else 1
+    nodes = 0
+    for move in list(board._generate_legal_moves()):
+        board.push(move)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+def divide(board: CustomBoard, depth: int) -> dict[str, int]:
+    counts = {}
+    for move in list(board._generate_legal_moves()):
+        board.push(move)
+        counts[move.uci()] = perft(board, depth - 1)
+        board.pop()
+    return counts
+
+def run(names: list[str], depth: int, show_divide: bool = False, jobs: int = 1) -> list[dict]:
+    # parallel imports this module for its workers, so it is only imported when asked for
+    if (jobs > 1):
+        from parallel import parallel_divide
+    results = []
+    for name, musketeer_fen, piece_types in POSITIONS:
+        if (names and name not in names):
+            continue
+        board = setup_board(musketeer_fen, piece_types)
+        start = time.perf_counter()
+        if (jobs > 1):
+            counts = parallel_divide(board, depth, jobs=jobs)
+            nodes = sum(counts.values())
+        elif (show_divide):
+            counts = divide(board, depth)
+            nodes = sum(counts.values())
+        else:
+            nodes = perft(board, depth)
+        seconds = time.perf_counter() - start
+        results.append({"name": name, "depth": depth, "nodes": nodes, "seconds": round(seconds, 4),
+                        "nps": int(nodes / seconds) if seconds > 0 else 0,
+                        "fen": board.musketeer_fen(), "pieces": [list(definition) for definition in board.piece_definitions()]})
+        print(f"{name:20} depth {depth}  nodes {nodes:10}  {seconds:8.3f} s  {results[-1]['nps']:8} nodes/s")
+        if (show_divide):
+            for uci, count in sorted(counts.items()):
+                print(f"    {uci}: {count}")
+    return results
+
+def encoding_benchmark(names: list[str], rounds: int = 2000) -> None:
+    # Round trips through CustomBoard.to_bytes() against the Musketeer FEN the board is usually shipped as
+    for name, musketeer_fen, piece_types in POSITIONS:
+        if (names and name not in names):
+            continue
+        board = setup_board(musketeer_fen, piece_types)
+        fen = board.musketeer_fen()
+        start = time.perf_counter()
+        for round in range (rounds):
+            CustomBoard().set_musketeer_fen(board.musketeer_fen())
+        fen_seconds = time.perf_counter() - start
+        data = board.to_bytes()
+        start = time.perf_counter()
+        for round in range (rounds):
+            CustomBoard.from_bytes(board.to_bytes())
+        bytes_seconds = time.perf_counter() - start
+        print(f"{name:20} fen {len(fen):3} chars {1e6 * fen_seconds / rounds:7.1f} us  "
+              f"bytes {len(data):3} {1e6 * bytes_seconds / rounds:7.1f} us  {fen_seconds / bytes_seconds:5.2f}x")
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: list[dict], baseline_path: str) -> bool:
+    # Node counts must match exactly, speed is reported as a ratio against the baseline
+    with open(baseline_path) as f:
+        baseline = {(entry["name"], entry["depth"]): entry for entry in json.load(f)["results"]}
+    ok = True
+    for entry in results:
+        old = baseline.get((entry["name"], entry["depth"]))
+        if (old is None):
+            continue
+        if ("pieces" in old and (old["fen"], old["pieces"]) != (entry["fen"], entry["pieces"])):
+            ok = False
+            print(f"{entry['name']:20} POSITION MISMATCH: {old['fen']} {old['pieces']} -> {entry['fen']} {entry['pieces']}")
+        elif (old["nodes"] != entry["nodes"]):
+            ok = False
+            print(f"{entry['name']:20} NODE MISMATCH: {old['nodes']} -> {entry['nodes']}")
+        elif (old["nps"]):
+            print(f"{entry['name']:20} {entry['nps'] / old['nps']:6.2f}x nodes/s")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Perft benchmark and regression suite for CustomBoard")
+    parser.add_argument("names", nargs="*", help="positions to run (default: all)")
+    parser.add_argument("-d", "--depth", type=int, default=3)
+    parser.add_argument("--divide", action="store_true", help="print node counts per root move")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="split the root moves across this many processes")
+    parser.add_argument("--json", help="save results to this file")
+    parser.add_argument("--compare", help="compare against results saved with --json")
+    parser.add_argument("--list", action="store_true", help="list the available positions")
+    parser.add_argument("--encoding", action="store_true", help="benchmark binary position round trips against FEN")
+    args = parser.parse_args()
+
+    if (args.list):
+        for name, musketeer_fen, piece_types in POSITIONS:
+            print(name, musketeer_fen)
+        raise SystemExit(0)
+
+    if (args.encoding):
+        encoding_benchmark(args.names)
+        raise SystemExit(0)
+
+    results = run(args.names, args.depth, args.divide, args.jobs)
+    if (args.json):
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2)
+    if (args.compare and not compare(results, args.compare)):
+        raise SystemExit(1)
@@ -47,48 +47,71 @@ function submitTempBetza() {
     displayBetza(full_betza.value, "highlight");
 }
 
+// Legal moves of the current position by from-square, fetched once and kept until a move is made
+let moveMap = null;
+let selectedSquare = null;
+
+function toSquare(index) {
+    return (7 - Math.floor(index / 8)) * 8 + index % 8; // Board orientation, works both ways
+}
+function getMoveMap() {
+    if (moveMap === null) {
+        moveMap = fetch('/move_map')
+            .then(response => response.json())
+            .then(data => data.moves);
+    }
+    return moveMap;
+}
+function drawPieces(fen) {
+    let squares = document.querySelectorAll(".chess-board div");
+    squares.forEach(square => {
+        let img = square.querySelector("img");
+        if (img) img.remove();
+    });
+    // The first and last rows of a Musketeer FEN are the gating rows
+    fen.split(" ")[0].split("/").slice(1, 9).forEach((row, i) => {
+        row.replace(/\d/g, m => " ".repeat(m)).split("").forEach((cell, j) => {
+            if (/[pnbrqk]/i.test(cell)) {
+                let img = document.createElement("img");
+                img.src = `/static/pieces/${cell === cell.toUpperCase() ? 'w' : 'b'}${cell}.png`;
+                squares[8 * i + j].appendChild(img);
+            }
+        });
+    });
+}
+function showLegalMoves(index) {
+    let squares = document.querySelectorAll(".chess-board div");
+    getMoveMap().then(moves => {
+        squares.forEach(square => square.classList.remove("highlight"));
+        (moves[toSquare(index)] || []).forEach(i => squares[toSquare(i)].classList.add("highlight"));
+    });
+}
+function makeMove(fromIndex, toIndex) {
+    fetch('/make_move/' + fromIndex + '/' + toIndex, {
+            method: 'POST'
+        })
+        .then(response => response.json())
+        .then(fen => {
+            moveMap = null;
+            document.querySelectorAll(".chess-board div").forEach(square => square.classList.remove("highlight"));
+            if (typeof fen === "string") drawPieces(fen);
+        });
+}
+
 document.addEventListener("DOMContentLoaded", function() {
     let squares = document.querySelectorAll(".chess-board div");
+    document.querySelector("#betzaSubmit").addEventListener("click", function() {
+        displayBetza(document.querySelector("#betzaInput").value, "highlight");
+    });
     squares.forEach((square, index) => {
-        document.querySelector("#betzaSubmit").addEventListener("click", function() {
-            displayBetza(document.querySelector("#betzaInput").value, "highlight");
+        square.addEventListener("click", function() {
+            if (square.classList.contains("highlight") && selectedSquare !== null) {
+                makeMove(selectedSquare, index);
+                selectedSquare = null;
+            } else {
+                selectedSquare = index;
+                showLegalMoves(index);
+            }
         });
-        // square.addEventListener("click", function() {
-        //     if (square.classList.contains("selected")) {
-        //         square.classList.remove("selected");
-        //     } else {
-        //         square.classList.add("selected");
-        //     }
-        //     if (square.classList.contains("highlight")) {
-        //         // Move the piece and update the board
-        //         fetch('/make_move/' + index, {
-        //                 method: 'POST'
-        //             })
-        //             .then(response => response.json())
-        //             .then(fen => {
-        //                 squares.forEach(square => {
-        //                     square.classList.remove("highlight");
-        //                     let img = square.querySelector("img");
-        //                     if (img) img.remove();
-        //                 });
-        //                 fen.split(" ")[0].split("/").forEach((row, i) => {
-        //                     row.replace(/\d/g, m => " ".repeat(m)).split("").forEach((cell, j) => {
-        //                         if (cell !== " ") {
-        //                             let img = document.createElement("img");
-        //                             img.src = `/static/pieces/${cell === cell.toUpperCase() ? 'w' : 'b'}${cell.toLowerCase()}.png`;
-        //                             squares[8 * i + j].appendChild(img);
-        //                         }
-        //                     });
-        //                 });
-        //             });
-        //     } else {
-        //         fetch('/legal_moves/' + index)
-        //             .then(response => response.json())
-        //             .then(data => {
-        //                 squares.forEach(square => square.classList.remove("highlight"));
-        //                 data.forEach(i => squares[(7 - Math.floor(i / 8)) * 8 + i % 8].classList.add("highlight")); // Correct for board orientation
-        //             });
-        //     }
-        // });
     });
-});
\ No newline at end of file
+});
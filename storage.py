@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+from board import *
+from games import Game, GameStore, new_game_id
+
+# SQLite persistence for the web app's games, so that any worker process can serve any game.
+# A row holds the CustomBoard.to_bytes() start and current positions, the Betza definitions they need
+# and the UCI moves between them, which are replayed on load so that the move stack comes back as well.
+# A GameStore in front of the database keeps boards in-process; the version column, bumped on
+# every save, tells a worker that another one has moved since it cached the game.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY,
+    start BLOB NOT NULL,
+    position BLOB NOT NULL,
+    definitions TEXT NOT NULL,
+    moves TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    updated REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+# Fixed statement strings, so that sqlite3 prepares each of them once per connection and reuses it
+SELECT_VERSION = "SELECT version FROM games WHERE game_id = ?"
+SELECT_GAME = "SELECT start, position, definitions, moves, version FROM games WHERE game_id = ?"
+INSERT_GAME = ("INSERT INTO games (game_id, start, position, definitions, moves, version, updated) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?)")
+UPDATE_GAME = ("UPDATE games SET start = ?, position = ?, definitions = ?, moves = ?, version = version + 1, updated = ? "
+               "WHERE game_id = ? AND version = ?")
+DELETE_GAME = "DELETE FROM games WHERE game_id = ?"
+DELETE_EXPIRED = "DELETE FROM games WHERE updated < ?"
+COUNT_GAMES = "SELECT COUNT(*) FROM games"
+
+DATABASE_TIMEOUT = 5.0
+
+class GameDatabase:
+    # Same interface as GameStore (get, create, update, discard, info), backed by a SQLite file
+    def __init__(self, path: str, cache: Optional[GameStore] = None, timeout: float = DATABASE_TIMEOUT):
+        self.path = path
+        self.cache = cache if cache is not None else GameStore()
+        self.timeout = timeout
+        self._local = threading.local()
+        connection = self._connection()
+        # WAL lets readers in every worker go on while one of them writes, and is remembered by the file
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(SCHEMA)
+        # Files written before the start position was stored get the column; their games load without a stack
+        if ("start" not in {column[1] for column in connection.execute("PRAGMA table_info(games)")}):
+            connection.execute("ALTER TABLE games ADD COLUMN start BLOB")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, opened again in a process forked after it was made
+        connection = getattr(self._local, "connection", None)
+        if (connection is None or self._local.pid != os.getpid()):
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _row(self, game: Game) -> tuple[bytes, bytes, str, str]:
+        # The root of the move stack and the moves from it, so that every worker rebuilds the same stack
+        board = game.board
+        return (board.root().to_bytes(), board.to_bytes(), json.dumps(board.piece_definitions()),
+                " ".join(move.uci() for move in board.move_stack))
+
+    def _replay(self, start: Optional[bytes], position: bytes, definitions, moves: str) -> CustomBoard:
+        # Moves were checked when they were played; if the replay does not end on the stored position
+        # (a gating move, which UCI cannot spell, or an old row without start), the position is used alone
+        if (start is not None):
+            board = CustomBoard.from_bytes(start)
+            board.set_piece_definitions(definitions)
+            try:
+                for uci in moves.split():
+                    board.push(Move.from_uci(uci))
+            except ValueError:
+                pass
+            else:
+                if (board.to_bytes() == position):
+                    return board
+        board = CustomBoard.from_bytes(position)
+        board.set_piece_definitions(definitions)
+        return board
+
+    def _load(self, game_id: str) -> Optional[Game]:
+        row = self._connection().execute(SELECT_GAME, (game_id, )).fetchone()
+        if (row is None):
+            self.cache.discard(game_id)
+            return None
+        start, position, definitions, moves, version = row
+        game = Game(game_id, self._replay(start, position, json.loads(definitions), moves))
+        game.version = version
+        return self.cache.add(game)
+
+    def get(self, game_id: str) -> Optional[Game]:
+        game = self.cache.get(game_id)
+        if (game is not None):
+            row = self._connection().execute(SELECT_VERSION, (game_id, )).fetchone()
+            if (row is not None and row[0] == game.version):
+                return game
+        return self._load(game_id)
+
+    def create(self, board: Optional[CustomBoard] = None) -> Game:
+        game = Game(new_game_id(), board if board is not None else self.cache.board_factory())
+        self._connection().execute(INSERT_GAME, (game.game_id, *self._row(game), game.version, time.time()))
+        return self.cache.add(game)
+
+    def update(self, game: Game) -> bool:
+        # Saves the game unless another worker saved it first; then the cached copy is dropped and
+        # False is returned, so that the caller reloads the game instead of overwriting the other move
+        cursor = self._connection().execute(UPDATE_GAME, (*self._row(game), time.time(), game.game_id, game.version))
+        if (cursor.rowcount == 0):
+            self.cache.discard(game.game_id)
+            return False
+        game.version += 1
+        if (not self.cache.update(game)):
+            self.cache.add(game)
+        return True
+
+    def discard(self, game_id: str) -> None:
+        self.cache.discard(game_id)
+        self._connection().execute(DELETE_GAME, (game_id, ))
+
+    def purge(self, max_age: float) -> int:
+        # Delete the games nobody moved in for max_age seconds, returns how many were deleted
+        self.cache.purge()
+        return self._connection().execute(DELETE_EXPIRED, (time.time() - max_age, )).rowcount
+
+    def __contains__(self, game_id: str) -> bool:
+        return self._connection().execute(SELECT_VERSION, (game_id, )).fetchone() is not None
+
+    def info(self) -> dict[str, int]:
+        info = self.cache.info()
+        info["stored"] = self._connection().execute(COUNT_GAMES).fetchone()[0]
+        return info
@@ -0,0 +1,27 @@
+import random
+import pytest
+np = pytest.importorskip("numpy")
+from batch import *
+from perft import POSITIONS, setup_board
+
+def sample_boards(plies: int = 40) -> list[CustomBoard]:
+    rng = random.Random(2)
+    boards = []
+    for name, musketeer_fen, piece_types in POSITIONS:
+        board = setup_board(musketeer_fen, piece_types)
+        for ply in range (plies):
+            boards.append(board.copy(stack=False))
+            moves = list(board.generate_legal_moves())
+            if (not moves):
+                break
+            board.push(rng.choice(moves))
+    return boards
+
+def test_batch_matches_boards():
+    boards = sample_boards()
+    batch = BoardBatch.from_boards(boards)
+    checks, white, black = batch.is_check(), batch.attacks(WHITE), batch.attacks(BLACK)
+    for index, board in enumerate(boards):
+        assert bool(checks[index]) == board.is_check(), board.musketeer_fen()
+        assert int(white[index]) == board.side_attacks_mask(WHITE), board.musketeer_fen()
+        assert int(black[index]) == board.side_attacks_mask(BLACK), board.musketeer_fen()
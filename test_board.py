@@ -0,0 +1,134 @@
+import random
+from board import *
+from perft import POSITIONS, setup_board
+import zobrist
+
+def pawn_variant_board(pawn_type: CustomPieceType) -> CustomBoard:
+    # White pawn on d5 between two black knights one rank behind it
+    board = CustomBoard(None)
+    board.add_custom_piece_type(CUSTOM_PIECE_TYPES[pawn_type])
+    board.set_piece_at(D5, Piece(PAWN, WHITE))
+    board.set_piece_at(C4, Piece(KNIGHT, BLACK))
+    board.set_piece_at(E4, Piece(KNIGHT, BLACK))
+    board.set_piece_at(A1, Piece(KING, WHITE))
+    board.set_piece_at(H8, Piece(KING, BLACK))
+    return board
+
+def test_backward_pawn_captures():
+    moves = {move.uci() for move in pawn_variant_board(SERGEANT).generate_legal_moves(BB_D5)}
+    assert {"d5c4", "d5e4"} <= moves
+
+def test_no_backward_pawn_captures():
+    for pawn_type in (CORPORAL, LIEUTENANT):
+        moves = {move.uci() for move in pawn_variant_board(pawn_type).generate_legal_moves(BB_D5)}
+        assert not {"d5c4", "d5e4"} & moves
+
+def test_king_cannot_step_into_backward_pawn_capture():
+    board = CustomBoard()
+    board.add_custom_piece_type(CUSTOM_PIECE_TYPES[GENERAL])
+    board.set_musketeer_fen("********/rn2qb2/pbk1nppr/1p6/1p1PPP2/1Q3P1P/2p1KN2/PP2B3/R1B4R/******** w - - 0 22")
+    assert Move.from_uci("e3d4") not in set(board._generate_legal_moves())
+
+def backward_capture_board(pawn_type: CustomPieceType, king: Square) -> CustomBoard:
+    # Black pawn on d4, which captures backward onto c5 and e5 with most pawn types
+    board = CustomBoard(None)
+    board.add_custom_piece_type(CUSTOM_PIECE_TYPES[pawn_type])
+    board.set_piece_at(D4, Piece(PAWN, BLACK))
+    board.set_piece_at(king, Piece(KING, WHITE))
+    board.set_piece_at(H8, Piece(KING, BLACK))
+    return board
+
+def test_backward_pawn_capture_attacks():
+    board = backward_capture_board(SERGEANT, E5)
+    assert board.is_attacked_by(BLACK, E5)
+    assert board.is_attacked_by(BLACK, C5)
+    assert not board.is_attacked_by(BLACK, D5)
+    assert board.is_check()
+    assert not backward_capture_board(CORPORAL, E5).is_check()
+
+def test_king_moves_next_to_backward_pawn_capture():
+    moves = {move.uci() for move in backward_capture_board(SERGEANT, E6).generate_legal_moves()}
+    assert "e6e5" not in moves
+    assert "e6d5" in moves
+    moves = {move.uci() for move in backward_capture_board(LIEUTENANT, E6).generate_legal_moves()}
+    assert "e6e5" in moves
+
+def attacked_squares(board: CustomBoard, color: Color) -> Bitboard:
+    return sum(BB_SQUARES[square] for square in SQUARES if board._attackers_mask(color, square, board.occupied))
+
+def test_side_attacks_mask_matches_attackers_mask():
+    assert backward_capture_board(SERGEANT, E6).side_attacks_mask(BLACK) & BB_E5
+    rng = random.Random(1)
+    for name, musketeer_fen, piece_types in POSITIONS:
+        board = setup_board(musketeer_fen, piece_types)
+        for ply in range (40):
+            for color in COLORS:
+                assert board.side_attacks_mask(color) == attacked_squares(board, color), (name, board.musketeer_fen())
+            moves = list(board.generate_legal_moves())
+            if (not moves):
+                break
+            board.push(rng.choice(moves))
+
+def test_ep_square_without_legal_capture_is_not_hashed():
+    board = CustomBoard()
+    board.push_san("e4")
+    reloaded = CustomBoard()
+    reloaded.set_musketeer_fen(board.musketeer_fen())
+    assert reloaded.ep_square is None
+    assert board.zobrist_hash() == reloaded.zobrist_hash() == zobrist.zobrist_hash(board)
+
+def test_repetition_after_double_pawn_push():
+    board = CustomBoard()
+    for san in ["e4", "Nf6", "Nf3", "Ng8", "Ng1", "Nf6", "Nf3", "Ng8"]:
+        board.push_san(san)
+    assert not board.is_repetition(3)
+    board.push_san("Ng1")
+    assert board.is_repetition(3)
+    assert board.can_claim_threefold_repetition()
+
+def random_walks(plies: int = 30):
+    # Every perft position with the boards of a random game from it
+    rng = random.Random(4)
+    for name, musketeer_fen, piece_types in POSITIONS:
+        board = setup_board(musketeer_fen, piece_types)
+        yield board
+        for ply in range (plies):
+            moves = list(board.generate_legal_moves())
+            if (not moves):
+                break
+            board.push(rng.choice(moves))
+            yield board
+
+def test_bytes_round_trip():
+    for board in random_walks():
+        copy = CustomBoard.from_bytes(board.to_bytes())
+        copy.set_piece_definitions(board.piece_definitions())
+        assert copy.musketeer_fen() == board.musketeer_fen()
+        assert copy.zobrist_hash() == board.zobrist_hash()
+        assert set(copy.generate_legal_moves()) == set(board.generate_legal_moves())
+
+def test_incremental_zobrist_matches_recomputed():
+    for board in random_walks():
+        assert board.zobrist_hash() == zobrist.zobrist_hash(board)
+        reloaded = CustomBoard()
+        reloaded.set_piece_definitions(board.piece_definitions())
+        for piece_type, betza in board.piece_definitions():
+            reloaded.add_custom_piece_type(piece_type, betza)
+        reloaded.set_musketeer_fen(board.musketeer_fen())
+        assert reloaded.zobrist_hash() == board.zobrist_hash()
+        if (board.move_stack):
+            move = board.pop()
+            assert board.zobrist_hash() == zobrist.zobrist_hash(board)
+            board.push(move)
+
+def test_repetition_of_custom_pieces():
+    board = setup_board(*dict((name, (fen, types)) for name, fen, types in POSITIONS)["riders"])
+    shuffle = [Move.from_uci(uci) for uci in ["c3e4", "c6b5", "e4c3", "b5c6"]]
+    for move in shuffle:
+        assert move in board.generate_legal_moves()
+        board.push(move)
+    assert board.is_repetition(2) and not board.is_repetition(3)
+    for move in shuffle:
+        board.push(move)
+    assert board.is_repetition(3)
+    assert board.can_claim_threefold_repetition()
@@ -0,0 +1,25 @@
+import json
+import pytest
+pytest.importorskip("flask")
+from index import CUSTOM_BETZA, MAX_BETZA_LENGTH, app
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def post_position(client, pieces: dict):
+    return client.post("/api/position", data={"pieces": json.dumps(pieces)})
+
+def test_position_token_round_trip(client):
+    response = post_position(client, {"8": "W"})
+    assert response.status_code == 200
+    token = response.get_json()["position"]
+    assert client.get(f"/api/move_map?position={token}").status_code == 200
+    # Client definitions stay on their boards
+    assert CUSTOM_BETZA == {}
+
+def test_position_rejects_long_betza(client):
+    assert post_position(client, {"8": "W" * (MAX_BETZA_LENGTH + 1)}).status_code == 400
+
+def test_position_rejects_too_many_custom_types(client):
+    assert post_position(client, {str(piece_type): "W" for piece_type in range (3, 14)}).status_code == 400
@@ -0,0 +1,27 @@
+import concurrent.futures
+from chess.engine import Limit, Mate
+from board import *
+import engine
+import parallel
+from perft import POSITIONS, setup_board
+
+def test_parallel_play_matches_searcher():
+    board = setup_board(*dict((name, (fen, types)) for name, fen, types in POSITIONS)["riders"])
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        result = parallel.parallel_play(board, Limit(depth=3), executor=executor)
+    expected = engine.Searcher().play(board, Limit(depth=3))
+    assert result.info["score"] == expected.info["score"]
+    assert result.info["depth"] == 3
+
+def test_parallel_play_mate():
+    board = CustomBoard("k7/8/1K6/8/8/8/8/6R1 w - - 0 1")
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        result = parallel.parallel_play(board, Limit(depth=3), executor=executor)
+    assert result.move == Move.from_uci("g1g8")
+    assert result.info["score"].white() == Mate(1)
+    assert result.info["depth"] == 3
+
+def test_parallel_perft():
+    board = setup_board(*POSITIONS[0][1:])
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        assert parallel.parallel_perft(board, 3, executor=executor) == 8902
@@ -0,0 +1,7 @@
+import pytest
+from perft import PERFT_EXPECTED, POSITIONS, perft, setup_board
+
+@pytest.mark.parametrize("name, musketeer_fen, piece_types", POSITIONS, ids=[position[0] for position in POSITIONS])
+def test_perft(name, musketeer_fen, piece_types):
+    board = setup_board(musketeer_fen, piece_types)
+    assert [perft(board, depth) for depth in (1, 2, 3)] == PERFT_EXPECTED[name]
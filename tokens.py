@@ -0,0 +1,61 @@
+import base64
+import hashlib
+import hmac
+import struct
+from board import *
+
+# Signed position tokens for the stateless API: the client holds the game and sends it with every call.
+# A token is base64url of CustomBoard.to_bytes(), the Betza definitions of the custom types in play
+# and a truncated HMAC-SHA256 over both, so a server only needs the key to trust and answer it.
+
+TOKEN_MAC_SIZE = 16
+DEFINITION_HEADER = struct.Struct(">BB")
+
+class InvalidTokenError(ValueError):
+    """Raised when a position token is malformed or its signature does not match."""
+
+def _mac(key: bytes, payload: bytes) -> bytes:
+    return hmac.new(key, payload, hashlib.sha256).digest()[:TOKEN_MAC_SIZE]
+
+def _encode_definitions(definitions: Iterable[tuple[CustomPieceType, Optional[str]]]) -> bytes:
+    # The count, then the type and length of each Betza string followed by the string itself
+    definitions = [(piece_type, betza.encode("ascii")) for piece_type, betza in definitions if betza is not None]
+    data = bytearray([len(definitions)])
+    for piece_type, betza in definitions:
+        if (len(betza) > 255):
+            raise ValueError(f"betza too long for a position token: {betza!r}")
+        data += DEFINITION_HEADER.pack(piece_type, len(betza))
+        data += betza
+    return bytes(data)
+
+def _decode_definitions(data: bytes, offset: int) -> tuple[list[tuple[CustomPieceType, str]], int]:
+    definitions = []
+    count = data[offset]
+    offset += 1
+    for index in range (count):
+        piece_type, length = DEFINITION_HEADER.unpack_from(data, offset)
+        offset += DEFINITION_HEADER.size
+        definitions.append((piece_type, data[offset:offset + length].decode("ascii")))
+        offset += length
+    return definitions, offset
+
+def position_token(board: CustomBoard, key: bytes) -> str:
+    definitions = _encode_definitions(board.piece_definitions())
+    payload = definitions + board.to_bytes()
+    return base64.urlsafe_b64encode(payload + _mac(key, payload)).rstrip(b"=").decode("ascii")
+
+def board_from_token(token: str, key: bytes) -> CustomBoard:
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError) as error:
+        raise InvalidTokenError(f"invalid position token: {token!r}") from error
+    payload, mac = data[:-TOKEN_MAC_SIZE], data[-TOKEN_MAC_SIZE:]
+    if (len(data) <= TOKEN_MAC_SIZE or not hmac.compare_digest(mac, _mac(key, payload))):
+        raise InvalidTokenError(f"bad signature on position token: {token!r}")
+    try:
+        definitions, offset = _decode_definitions(payload, 0)
+        board = CustomBoard.from_bytes(payload[offset:])
+        board.set_piece_definitions(definitions)
+        return board
+    except (ValueError, IndexError, struct.error) as error:
+        raise InvalidTokenError(f"invalid position token: {token!r}") from error
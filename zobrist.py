@@ -0,0 +1,55 @@
+import random
+from chess import BB_SQUARES, Bitboard, Color, Square, WHITE, scan_forward, square_file
+from typing import Optional
+
+# Zobrist keys for Musketeer positions: standard and custom pieces on every square,
+# castling rights, en passant file, side to move and the pending gate slots.
+# The seed is fixed so every process (and every worker) agrees on the keys.
+_random = random.Random(0x4D55534B)
+
+def _key() -> int:
+    return _random.getrandbits(64)
+
+ZOBRIST_PIECES = [[[_key() for square in range (64)] for color in range (2)] for piece_type in range (7)]
+ZOBRIST_CUSTOM_PIECES = [[[_key() for square in range (64)] for color in range (2)] for piece_type in range (16)]
+ZOBRIST_CASTLING = [_key() for square in range (64)]
+ZOBRIST_EP = [_key() for file in range (8)]
+ZOBRIST_TURN = _key()
+ZOBRIST_GATES = [[[_key() for position in range (9)] for slot in range (2)] for color in range (2)]
+
+def piece_key(piece_type: int, color: Color, square: Square) -> int:
+    return ZOBRIST_PIECES[piece_type][color][square]
+
+def custom_piece_key(piece_type: int, color: Color, square: Square) -> int:
+    return ZOBRIST_CUSTOM_PIECES[piece_type][color][square]
+
+def state_key(turn: Color, castling_rights: Bitboard, ep_square: Optional[Square], gated_positions: list[list[int]]) -> int:
+    # The part of the key that is cheap enough to compute on demand. Pass ep_square only when an
+    # en passant capture is legal, like polyglot, or the same position gets two keys
+    key = ZOBRIST_TURN if turn == WHITE else 0
+    for square in scan_forward(castling_rights):
+        key ^= ZOBRIST_CASTLING[square]
+    if (ep_square is not None):
+        key ^= ZOBRIST_EP[square_file(ep_square)]
+    for color in range (2):
+        for slot in range (2):
+            if (0 <= gated_positions[color][slot] < 9):
+                key ^= ZOBRIST_GATES[color][slot][gated_positions[color][slot]]
+    return key
+
+def legal_ep_square(board) -> Optional[Square]:
+    return board.ep_square if board.ep_square is not None and board.has_legal_en_passant() else None
+
+def placement_key(board) -> int:
+    # Full recomputation of the piece part of the key, which CustomBoard otherwise updates incrementally
+    key = 0
+    for square in scan_forward(board.occupied):
+        color = bool(board.occupied_co[WHITE] & BB_SQUARES[square])
+        if (board.custom_mailbox[square] is not None):
+            key ^= custom_piece_key(board.custom_mailbox[square], color, square)
+        else:
+            key ^= piece_key(board.piece_type_at(square), color, square)
+    return key
+
+def zobrist_hash(board) -> int:
+    return placement_key(board) ^ state_key(board.turn, board.castling_rights, legal_ep_square(board), board.gated_positions)